@@ -1,16 +1,20 @@
-
 """
 Usage:
-    geekcms gitupload
+    geekcms gitupload [--full]
+
+Options:
+    --full  Stage all files of outputs, ignoring the change manifest.
 
 """
 
 from datetime import datetime
 import subprocess
+import json
+import time
 import os
 
 from geekcms.protocol import BaseExtendedProcedure
-from geekcms.utils import PathResolver
+from geekcms.utils import PathResolver, ShareData
 
 
 class CWDContextManager:
@@ -22,8 +26,50 @@ class CWDContextManager:
         os.chdir(PathResolver.project_path)
 
 
+class ChangeManifest:
+
+    """
+    Paths of outputs changed since the last upload, recorded by themes in a
+    json file ({"full": bool, "paths": [...]}) under the states directory,
+    located by 'change_manifest' of settings.
+    """
+
+    def __init__(self):
+        rel_path = ShareData.get('git_upload.change_manifest')
+        self.abs_path = None
+        if rel_path:
+            self.abs_path = os.path.join(PathResolver.states(), rel_path)
+
+    def load(self):
+        # None means changes are unknown.
+        if self.abs_path is None:
+            return None
+        try:
+            with open(self.abs_path) as f:
+                changes = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if changes.get('full', True):
+            return None
+        return changes['paths']
+
+    def clear(self):
+        if self.abs_path and os.path.exists(self.abs_path):
+            os.remove(self.abs_path)
+
+
 class GitUploader(BaseExtendedProcedure):
 
+    """
+    With a change manifest, only changed paths are hashed(hash-object
+    --stdin-paths) and staged(update-index --index-info) in batches. Otherwise
+    all files are staged by 'git add'. The commit is skipped if the staged
+    tree is the same as the tree of HEAD.
+    """
+
+    BATCH_SIZE = 1000
+    NULL_SHA1 = '0' * 40
+
     def get_command_and_explanation(self):
         return ('gitupload',
                 'Automatically commit and push all files of outputs.')
@@ -31,15 +77,93 @@ class GitUploader(BaseExtendedProcedure):
     def get_doc(self):
         return __doc__
 
-    def run(self, args):
+    def _git(self, *args, input=None):
+        return subprocess.check_output(
+            ['git'] + list(args),
+            input=input,
+        ).decode('utf-8').strip()
+
+    def _get_head_tree(self):
+        # None if HEAD does not exist yet.
+        try:
+            return self._git('rev-parse', '--verify', '-q', 'HEAD^{tree}')
+        except subprocess.CalledProcessError:
+            return None
+
+    def _get_mode(self, path):
+        if os.path.islink(path):
+            return '120000'
+        return '100755' if os.stat(path).st_mode & 0o111 else '100644'
+
+    def _stage_paths(self, paths):
+        for start in range(0, len(paths), self.BATCH_SIZE):
+            batch = paths[start:start + self.BATCH_SIZE]
+            existing = [path for path in batch if os.path.lexists(path)]
+            deleted = [path for path in batch if not os.path.lexists(path)]
+
+            shas = []
+            if existing:
+                shas = self._git(
+                    'hash-object', '-w', '--stdin-paths',
+                    input='\n'.join(existing).encode('utf-8'),
+                ).split()
+
+            # mode sha1 TAB path, records of mode 0 remove paths.
+            records = [
+                '{} {}\t{}'.format(self._get_mode(path), sha, path)
+                for path, sha in zip(existing, shas)
+            ]
+            records.extend(
+                '0 {}\t{}'.format(self.NULL_SHA1, path) for path in deleted
+            )
+            self._git(
+                'update-index', '-z', '--index-info',
+                input=''.join(record + '\0' for record in records)
+                .encode('utf-8'),
+            )
+
+    def _commit(self, tree, head_tree):
         commit_text = 'GeekCMS Update, {}'.format(
             datetime.now().strftime('%c'),
         )
-        commands = [
-            ['git', 'add', '--all', '.'],
-            ['git', 'commit', '-m', commit_text],
-            ['git', 'push'],
-        ]
+        args = ['commit-tree', tree, '-m', commit_text]
+        if head_tree is not None:
+            args.extend(['-p', 'HEAD'])
+        commit = self._git(*args)
+        self._git('update-ref', 'HEAD', commit)
+        return commit
+
+    def _report(self, timings):
+        print(', '.join(
+            '{}: {:.3f}s'.format(step, seconds) for step, seconds in timings
+        ))
+
+    def run(self, args):
+        manifest = ChangeManifest()
+        paths = None if args['--full'] else manifest.load()
+
+        timings = []
         with CWDContextManager():
-            for command in commands:
-                subprocess.check_call(command)
+            start = time.perf_counter()
+            if paths is None:
+                print('Staging all files.')
+                self._git('add', '--all', '.')
+            else:
+                print('Staging {} changed file(s).'.format(len(paths)))
+                self._stage_paths(paths)
+            timings.append(('stage', time.perf_counter() - start))
+
+            start = time.perf_counter()
+            tree = self._git('write-tree')
+            head_tree = self._get_head_tree()
+            if tree == head_tree:
+                print('Nothing changed, commit skipped.')
+            else:
+                print('Committed {}.'.format(self._commit(tree, head_tree)))
+            manifest.clear()
+            timings.append(('commit', time.perf_counter() - start))
+
+            start = time.perf_counter()
+            subprocess.check_call(['git', 'push'])
+            timings.append(('push', time.perf_counter() - start))
+        self._report(timings)
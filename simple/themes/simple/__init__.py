@@ -1,3 +1,6 @@
 from . import load
 from . import process
 from . import write
+from . import watch
+from . import benchmark
+from . import serve
@@ -4,11 +4,17 @@ import os
 from geekcms.protocol import BaseResource, BaseProduct
 from geekcms.utils import PathResolver, ShareData
 
+from .utils import AssetManifest
+
 
 class _File(BaseResource):
 
     def __init__(self, abs_path):
         self.abs_path = abs_path
+        # set by loaders, see LoadManifest.
+        self.signature = None
+        self.status = None
+        self._text = None
 
     @property
     def base_path(self):
@@ -22,11 +28,20 @@ class _File(BaseResource):
         )
         return path
 
+    def _read(self):
+        with open(self.abs_path) as f:
+            return f.read()
+
     @property
     def text(self):
-        with open(self.abs_path) as f:
-            data = f.read()
-        return data
+        # read lazily and only once.
+        if self._text is None:
+            self._text = self._read()
+        return self._text
+
+    def release(self):
+        # text would be read again on next access.
+        self._text = None
 
 
 class _FileOfInputs(_File):
@@ -54,7 +69,18 @@ class IndexFile(MarkdownFile):
 
 
 class StaticFile(_FileOfInputs):
-    pass
+
+    # processed copy(minified) published instead of the file itself.
+    processed_abs_path = None
+
+    @property
+    def output_rel_path(self):
+        # rel_path of outputs directory.
+        return self.rel_path
+
+    @property
+    def publish_abs_path(self):
+        return self.processed_abs_path or self.abs_path
 
 
 class StaticFileOfInputs(StaticFile):
@@ -69,6 +95,11 @@ class _FileOfThemeStatic(StaticFile):
     def base_path(self):
         return PathResolver.theme_dir(self.THEME)
 
+    @property
+    def output_rel_path(self):
+        # fingerprinted by AssetFingerprinter.
+        return AssetManifest.get_rel_path(self.rel_path)
+
 
 class StaticFileOfThemeSimple(_FileOfThemeStatic):
 
@@ -78,6 +109,11 @@ class StaticFileOfThemeSimple(_FileOfThemeStatic):
 # pages
 class Page(BaseProduct):
 
+    # set by OutputMinifier.
+    minified = False
+    # pages other than data files are listed in sitemap.
+    IN_SITEMAP = True
+
     def __init__(self, text, rel_path):
         # rel_path with outputs directory as base.
         self.rel_path = rel_path
@@ -92,6 +128,17 @@ class ArticlePage(Page):
     pass
 
 
+class SearchIndexPage(Page):
+
+    # json data files of client side search.
+    IN_SITEMAP = False
+
+    REL_DIR = 'search'
+
+    def __init__(self, text, name):
+        super().__init__(text, '{}/{}.json'.format(self.REL_DIR, name))
+
+
 class _SpecialPage(Page):
 
     def __init__(self, text):
@@ -105,6 +152,22 @@ class TimeLinePage(_SpecialPage):
 
     REL_PATH = ShareData.get('simple.time_line_page')
 
+    def __init__(self, text, page_number=1):
+        Page.__init__(self, text, self.get_rel_path(page_number))
+        self.page_number = page_number
+
+    @classmethod
+    def get_rel_path(cls, page_number):
+        # speical/timeline.html, speical/timeline/2.html, ...
+        if page_number == 1:
+            return cls.REL_PATH
+        root, ext = os.path.splitext(cls.REL_PATH)
+        return '{}/{}{}'.format(root, page_number, ext)
+
+    @classmethod
+    def get_url(cls, page_number):
+        return '/' + cls.get_rel_path(page_number)
+
 
 class ArchivePage(_SpecialPage):
 
@@ -0,0 +1,291 @@
+"""
+Usage:
+    geekcms benchmark [options]
+
+Options:
+    --articles=<n>      Number of articles. [default: 1000]
+    --depth=<n>         Depth of topics. [default: 2]
+    --topics=<n>        Number of sub-topics of each topic. [default: 4]
+    --code-blocks=<n>   Number of code blocks of each article. [default: 2]
+    --statics=<n>       Number of static files. [default: 20]
+    --static-size=<kb>  Size of each static file in KB. [default: 256]
+    --runs=<n>          Builds on the same site, all but the first are warm.
+                        [default: 2]
+    --seed=<n>          Seed of the synthetic site. [default: 0]
+    --output=<path>     Path of result json, defaults to
+                        states/simple/benchmarks/<time>.json.
+    --keep              Keep the synthetic site.
+
+"""
+
+# This module is also executed as a script in child processes to profile a
+# single build, so it must not use relative imports.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import subprocess
+from datetime import date, datetime, timedelta
+
+from geekcms.protocol import BaseExtendedProcedure, PluginRegister
+from geekcms.utils import PathResolver
+
+
+_PROJECT_SETTINGS = """[RegisterTheme]
+themes: simple
+
+[Share]
+domain: www.example.org
+disqus_shortname: benchmark
+"""
+
+_WORDS = ('geek cms theme markdown render template archive timeline page '
+          'static sitemap python cache build plugin resource product').split()
+
+_CODE = """```python
+def function_{0}(items):
+    # synthetic code block.
+    result = {{}}
+    for index, item in enumerate(items):
+        if item not in result:
+            result[item] = index * {0}
+    return sorted(result.items(), key=lambda x: x[1])
+```
+"""
+
+
+class SyntheticSite:
+
+    """
+    Generate a project with theme simple, at a configurable scale.
+    """
+
+    def __init__(self, project_path, articles, depth, topics, code_blocks,
+                 statics, static_size, seed):
+        self.project_path = project_path
+        self.articles = articles
+        self.depth = depth
+        self.topics = topics
+        self.code_blocks = code_blocks
+        self.statics = statics
+        self.static_size = static_size
+        self._random = random.Random(seed)
+
+    def _join(self, *paths):
+        path = os.path.join(self.project_path, *paths)
+        dir_path, _ = os.path.split(path)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        return path
+
+    def _write(self, text, *paths):
+        with open(self._join(*paths), 'w') as f:
+            f.write(text)
+
+    def _sentence(self, length):
+        words = [self._random.choice(_WORDS) for _ in range(length)]
+        return ' '.join(words).capitalize() + '.'
+
+    def _markdown(self, title, post_date, code_blocks):
+        lines = [
+            'Title: {}'.format(title),
+            'Date: {}'.format(post_date.strftime('%d/%m/%Y')),
+            '',
+        ]
+        for index in range(max(code_blocks, 1) * 2):
+            lines.append('## {}'.format(self._sentence(3)))
+            lines.append('')
+            lines.append(' '.join(self._sentence(12) for _ in range(5)))
+            lines.append('')
+            if index % 2 and code_blocks:
+                lines.append(_CODE.format(index))
+        return '\n'.join(lines)
+
+    def _topic_dirs(self):
+        dirs = []
+        for index in range(self.topics ** self.depth):
+            parts = []
+            for _ in range(self.depth):
+                index, part = divmod(index, self.topics)
+                parts.append('topic-{}'.format(part))
+            dirs.append(os.path.join(*parts) if parts else '')
+        return dirs
+
+    def generate(self, theme_dir):
+        self._write(_PROJECT_SETTINGS, 'settings')
+        for dirname in ['outputs', 'states']:
+            os.makedirs(self._join(dirname))
+        shutil.copytree(
+            theme_dir,
+            self._join('themes', 'simple'),
+            ignore=shutil.ignore_patterns('__pycache__'),
+        )
+
+        first_date = date(2010, 1, 1)
+        self._write(self._markdown('About', first_date, 0),
+                    'inputs', 'about', 'about.md')
+        self._write(self._markdown('Welcome', first_date, 0),
+                    'inputs', 'index', 'welcome.md')
+
+        topic_dirs = self._topic_dirs()
+        for index in range(self.articles):
+            post_date = first_date + timedelta(
+                days=self._random.randrange(365 * 10),
+            )
+            self._write(
+                self._markdown(self._sentence(4), post_date, self.code_blocks),
+                'inputs', 'article', topic_dirs[index % len(topic_dirs)],
+                'article-{}.md'.format(index),
+            )
+
+        for index in range(self.statics):
+            path = self._join('inputs', 'static', 'assets',
+                              'asset-{}.bin'.format(index))
+            with open(path, 'wb') as f:
+                f.write(self._random.randbytes(self.static_size * 1024))
+
+
+def _get_max_rss_kb(children=False):
+    # None if unavailable, resource is a POSIX only module.
+    try:
+        import resource
+    except ImportError:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    # ru_maxrss is in bytes on macOS, in kilobytes elsewhere.
+    max_rss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        max_rss //= 1024
+    return max_rss
+
+
+def _profile_build(project_path, result_path):
+    # executed in a child process, build the project with timing of plugins.
+    from geekcms.loadup import SettingsProcedure, PluginProcedure
+
+    os.chdir(project_path)
+    start = time.perf_counter()
+    SettingsProcedure.run(project_path)
+    plugin_order, _ = PluginProcedure.run()
+    setup = time.perf_counter() - start
+
+    plugins = []
+    for plugin_index in plugin_order:
+        plugin = PluginRegister.get_plugin(plugin_index)()
+        wall, cpu = time.perf_counter(), time.process_time()
+        plugin.run()
+        plugins.append({
+            'plugin': plugin_index.unique_key,
+            'wall': time.perf_counter() - wall,
+            'cpu': time.process_time() - cpu,
+            'max_rss_kb': _get_max_rss_kb(),
+        })
+
+    result = {
+        'setup': setup,
+        'wall': time.perf_counter() - start,
+        'plugins': plugins,
+        'max_rss_kb': _get_max_rss_kb(),
+        # worker processes, such as md_workers.
+        'children_max_rss_kb': _get_max_rss_kb(children=True),
+    }
+    with open(result_path, 'w') as f:
+        json.dump(result, f)
+
+
+class Benchmark(BaseExtendedProcedure):
+
+    def get_command_and_explanation(self):
+        return ('benchmark',
+                'Build a synthetic site and report time and memory usage.')
+
+    def get_doc(self):
+        return __doc__
+
+    def _get_parameters(self, args):
+        return {
+            'articles': int(args['--articles']),
+            'depth': int(args['--depth']),
+            'topics': int(args['--topics']),
+            'code_blocks': int(args['--code-blocks']),
+            'statics': int(args['--statics']),
+            'static_size': int(args['--static-size']),
+            'seed': int(args['--seed']),
+        }
+
+    def _get_output_path(self, args):
+        if args['--output']:
+            return args['--output']
+        output_dir = os.path.join(
+            PathResolver.theme_state('simple', ensure_exist=True),
+            'benchmarks',
+        )
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        return os.path.join(
+            output_dir,
+            datetime.now().strftime('%Y%m%d-%H%M%S.json'),
+        )
+
+    def _build(self, project_path):
+        result_path = os.path.join(project_path, 'benchmark_result.json')
+        subprocess.check_call(
+            [sys.executable, os.path.abspath(__file__),
+             project_path, result_path],
+            stdout=subprocess.DEVNULL,
+        )
+        with open(result_path) as f:
+            return json.load(f)
+
+    def _report(self, index, build):
+        max_rss = build['max_rss_kb']
+        print('Build {}: {:.3f}s, {:.1f} articles/s, peak RSS {}'.format(
+            index, build['wall'], build['throughput'],
+            'unavailable' if max_rss is None else '{} KB'.format(max_rss),
+        ))
+        print('    {:<32}{:>10}{:>10}'.format('plugin', 'wall(s)', 'cpu(s)'))
+        for plugin in build['plugins']:
+            print('    {:<32}{:>10.3f}{:>10.3f}'.format(
+                plugin['plugin'], plugin['wall'], plugin['cpu'],
+            ))
+
+    def run(self, args):
+        parameters = self._get_parameters(args)
+        output_path = self._get_output_path(args)
+
+        project_path = tempfile.mkdtemp(prefix='geekcms-benchmark-')
+        try:
+            SyntheticSite(project_path, **parameters).generate(
+                PathResolver.theme_dir('simple'),
+            )
+            builds = []
+            for index in range(int(args['--runs'])):
+                build = self._build(project_path)
+                build['throughput'] = parameters['articles'] / build['wall']
+                builds.append(build)
+                self._report(index + 1, build)
+        finally:
+            if args['--keep']:
+                print('Synthetic site: {}'.format(project_path))
+            else:
+                shutil.rmtree(project_path)
+
+        result = {
+            'created': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': parameters,
+            'builds': builds,
+        }
+        with open(output_path, 'w') as f:
+            json.dump(result, f, indent=1)
+        print('Result: {}'.format(output_path))
+
+
+if __name__ == '__main__':
+    _profile_build(*sys.argv[1:])
@@ -0,0 +1,104 @@
+"""
+Opt-in instrumentation of plugins, enabled by 'profile' of theme settings.
+Wall time, CPU time, number of incoming items and allocations of every
+plugin run are recorded, and summarized at the end of the build. If
+'profile_dump' is set as well, cProfile stats of every plugin would be
+dumped to states/simple/profile/<plugin>.pstats.
+"""
+
+import os
+import time
+import atexit
+import cProfile
+import tracemalloc
+from functools import wraps
+
+from geekcms.utils import PathResolver
+
+from .utils import share_flag
+
+
+class PluginProfiler:
+
+    _records = []
+    _report_registered = False
+
+    @classmethod
+    def _get_dump_path(cls, plugin_name):
+        dump_dir = os.path.join(
+            PathResolver.theme_state('simple', ensure_exist=True),
+            'profile',
+        )
+        if not os.path.exists(dump_dir):
+            os.makedirs(dump_dir)
+        return os.path.join(dump_dir, '{}.pstats'.format(plugin_name))
+
+    @classmethod
+    def profile(cls, plugin, func, args):
+        if not cls._report_registered:
+            atexit.register(cls.report)
+            cls._report_registered = True
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        start_memory, _ = tracemalloc.get_traced_memory()
+
+        profiler = None
+        if share_flag('simple.profile_dump', False):
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            return func(plugin, *args)
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(cls._get_dump_path(plugin.plugin))
+            end_memory, peak_memory = tracemalloc.get_traced_memory()
+
+            cls._records.append({
+                'plugin': plugin.plugin,
+                'wall': wall,
+                'cpu': cpu,
+                # resources, products or messages passed to run.
+                'items': sum(len(items) for items in args),
+                'allocated_kb': (end_memory - start_memory) // 1024,
+                'peak_kb': (peak_memory - start_memory) // 1024,
+            })
+
+    @classmethod
+    def report(cls):
+        if not cls._records:
+            return
+        row = '{:<22}{:>10}{:>10}{:>8}{:>14}{:>12}'
+        print(row.format('plugin', 'wall(s)', 'cpu(s)', 'items',
+                         'allocated(KB)', 'peak(KB)'))
+        for record in cls._records:
+            print(row.format(
+                record['plugin'],
+                '{:.3f}'.format(record['wall']),
+                '{:.3f}'.format(record['cpu']),
+                record['items'],
+                record['allocated_kb'],
+                record['peak_kb'],
+            ))
+        print(row.format(
+            'total',
+            '{:.3f}'.format(sum(record['wall'] for record in cls._records)),
+            '{:.3f}'.format(sum(record['cpu'] for record in cls._records)),
+            '', '', '',
+        ))
+
+
+def instrument(func):
+    # decorate run method of plugin, should be placed above accept_parameters.
+    @wraps(func)
+    def run(self, *args):
+        if not share_flag('simple.profile', False):
+            return func(self, *args)
+        return PluginProfiler.profile(self, func, args)
+    return run
@@ -7,7 +7,8 @@ from geekcms.protocol import PluginController as pcl
 
 from .assets import (ArticleFile, AboutFile, IndexFile,
                      StaticFileOfInputs, StaticFileOfThemeSimple)
-from .utils import AVALIABLE_MD_EXTENSIONS
+from .instrument import instrument
+from .utils import AVALIABLE_MD_EXTENSIONS, LoadManifest, share_flag
 
 
 class _LoadMethod:
@@ -19,35 +20,76 @@ class _LoadMethod:
         )
         return dir_path
 
-    def _load_files_in_dir(self, top, avaliable_exts=None):
-
-        for dirpath, dirnames, filenames in os.walk(top):
-            for name in filenames:
-                _, ext = os.path.splitext(name)
-
-                if avaliable_exts is None:
-                    pass
-                elif ext not in avaliable_exts:
-                    continue
-                elif name.startswith('.'):
-                    continue
+    def _is_avaliable_file(self, name, avaliable_exts=None):
+        _, ext = os.path.splitext(name)
+
+        if avaliable_exts is None:
+            return True
+        elif ext not in avaliable_exts:
+            return False
+        elif name.startswith('.'):
+            return False
+        return True
+
+    def _scan_files_in_dir(self, top, avaliable_exts=None):
+        # os.scandir returns file types along with names, and caches the
+        # result of stat.
+        try:
+            entries = list(os.scandir(top))
+        except OSError:
+            return
+
+        sub_dirs = []
+        for entry in entries:
+            if entry.is_dir():
+                # same as os.walk, symbolic links to directories would not be
+                # followed.
+                if not entry.is_symlink():
+                    sub_dirs.append(entry.path)
+                continue
+
+            if not self._is_avaliable_file(entry.name, avaliable_exts):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                # broken symbolic links, or files removed while scanning.
+                continue
+            yield entry.path, stat
+
+        for sub_dir in sub_dirs:
+            yield from self._scan_files_in_dir(sub_dir, avaliable_exts)
+
+    def _load_file(self, manager, abs_path, stat):
+        resource = manager.create(abs_path)
+        resource.signature = LoadManifest.get_signature(stat)
+        resource.status = LoadManifest.update(
+            abs_path,
+            resource.signature,
+        )
+        return resource
 
-                yield os.path.join(dirpath, name)
+    def _load_dir(self, dir_path, resource_cls, avaliable_exts=None):
+        # get manager of resource_cls.
+        manager = self.get_manager_bind_with_plugin(resource_cls)
+        # walk through dir_path, mark status of resources by stat.
+        for abs_path, stat in self._scan_files_in_dir(dir_path,
+                                                      avaliable_exts):
+            self._load_file(manager, abs_path, stat)
+        # saved once per build by consumers of status, see MarkdownProcessor.
+        LoadManifest.finish_dir(dir_path)
 
     def _load(self, dirname, resource_cls, avaliable_exts=None):
         # get abs path of dirname.
         dir_path = self._get_dir_path_of_inpouts(dirname)
-        # get manager of resource_cls.
-        manager = self.get_manager_bind_with_plugin(resource_cls)
-        # walk through path of dirname.
-        for abs_path in self._load_files_in_dir(dir_path, avaliable_exts):
-            manager.create(abs_path)
+        self._load_dir(dir_path, resource_cls, avaliable_exts)
 
 
 class InputsStaticFileLoader(BasePlugin, _LoadMethod):
 
     plugin = 'load_inputs_static'
 
+    @instrument
     def run(self):
         self._load('static', StaticFileOfInputs)
 
@@ -56,6 +98,7 @@ class AboutMeLoader(BasePlugin, _LoadMethod):
 
     plugin = 'load_about'
 
+    @instrument
     def run(self):
         self._load('about', AboutFile, AVALIABLE_MD_EXTENSIONS)
 
@@ -64,6 +107,7 @@ class IndexLoader(BasePlugin, _LoadMethod):
 
     plugin = 'load_index'
 
+    @instrument
     def run(self):
         self._load('index', IndexFile, AVALIABLE_MD_EXTENSIONS)
 
@@ -72,6 +116,7 @@ class ArticleLoader(BasePlugin, _LoadMethod):
 
     plugin = 'load_article'
 
+    @instrument
     def run(self):
         self._load('article', ArticleFile, AVALIABLE_MD_EXTENSIONS)
 
@@ -80,11 +125,22 @@ class ThemesStaticFileLoader(BasePlugin, _LoadMethod):
 
     plugin = 'load_theme_static'
 
+    # files of optional features, published only if the feature is enabled.
+    FEATURE_FILES = {
+        os.path.join('js', 'search.js'): 'simple.search',
+    }
+
+    @instrument
     def run(self):
         dir_path = os.path.join(
             PathResolver.theme_dir('simple'),
             'static',
         )
-        manager = self.get_manager_bind_with_plugin(StaticFileOfThemeSimple)
-        for abs_path in self._load_files_in_dir(dir_path):
-            manager.create(abs_path)
+        self._load_dir(dir_path, StaticFileOfThemeSimple)
+        for static_file in StaticFileOfThemeSimple.objects.values():
+            key = self.FEATURE_FILES.get(
+                os.path.relpath(static_file.abs_path, dir_path),
+                None,
+            )
+            if key and not share_flag(key, False):
+                StaticFileOfThemeSimple.objects.remove(static_file)
@@ -0,0 +1,135 @@
+"""
+Conservative minifiers of html, css and js, which never change the meaning of
+documents:
+
+1. html: comments are removed and whitespace is collapsed, except in pre,
+code, textarea, script and style elements. Whitespace containing a line break
+is collapsed to a line break, otherwise to a space.
+2. css: comments are removed, whitespace is collapsed, and dropped around
+punctuations where it is insignificant. Strings are kept.
+3. js: leading and trailing whitespace of lines and blank lines are removed.
+Comments are kept, since telling them from strings and regular expressions
+needs a real parser.
+"""
+
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from .utils import get_fork_context
+
+
+# bumped whenever minified results change, which are cached by it.
+VERSION = 1
+
+_HTML_PROTECTED_RE = re.compile(
+    r'(<(pre|code|textarea|script|style)\b.*?</\2\s*>)',
+    re.IGNORECASE | re.DOTALL,
+)
+# conditional comments are kept.
+_HTML_COMMENT_RE = re.compile(r'<!--(?!\[if).*?-->', re.DOTALL)
+_WHITESPACE_RE = re.compile(r'\s+')
+
+_CSS_TOKEN_RE = re.compile(
+    r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')'''
+    # comments, except /*! ... */ which are meant to be kept.
+    r'|(/\*(?!!).*?\*/)'
+    r'|(\s+)',
+    re.DOTALL,
+)
+_CSS_PUNCTUATION_RE = re.compile(r'\s*([{};,>])\s*')
+_CSS_COLON_RE = re.compile(r':\s+')
+_CSS_STRING_RE = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')''')
+
+
+def _collapse_whitespace(match):
+    return '\n' if '\n' in match.group() else ' '
+
+
+def minify_html(text):
+    parts = _HTML_PROTECTED_RE.split(text)
+    minified = []
+    # split yields text, protected element and its tag name in turn.
+    for index in range(0, len(parts), 3):
+        segment = _HTML_COMMENT_RE.sub('', parts[index])
+        minified.append(_WHITESPACE_RE.sub(_collapse_whitespace, segment))
+        if index + 1 < len(parts):
+            minified.append(parts[index + 1])
+    return ''.join(minified).strip() + '\n'
+
+
+def _minify_css_token(match):
+    string, comment, whitespace = match.groups()
+    if string:
+        return string
+    if comment:
+        return ''
+    return ' '
+
+
+def _minify_css_code(code):
+    code = _CSS_PUNCTUATION_RE.sub(r'\1', code)
+    # spaces before colons are significant in selectors(a :hover).
+    code = _CSS_COLON_RE.sub(':', code)
+    return code.replace(';}', '}')
+
+
+def minify_css(text):
+    text = _CSS_TOKEN_RE.sub(_minify_css_token, text)
+    # strings are left untouched.
+    parts = _CSS_STRING_RE.split(text)
+    for index in range(0, len(parts), 2):
+        parts[index] = _minify_css_code(parts[index])
+    return ''.join(parts).strip() + '\n'
+
+
+def minify_js(text):
+    lines = (line.strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines if line) + '\n'
+
+
+MINIFIERS = {
+    '.html': minify_html,
+    '.css': minify_css,
+    '.js': minify_js,
+}
+
+
+def minify(ext_and_text):
+    # executed in worker processes of OutputMinifier.
+    ext, text = ext_and_text
+    return MINIFIERS[ext](text)
+
+
+def minify_all(jobs, workers):
+    # jobs are (ext, text) pairs, minified by worker processes if workers > 1
+    # and processes could be forked, see get_fork_context.
+    context = get_fork_context()
+    if workers <= 1 or len(jobs) <= 1 or context is None:
+        return [minify(job) for job in jobs]
+    chunksize = max(1, len(jobs) // (workers * 4))
+    with ProcessPoolExecutor(workers, mp_context=context) as executor:
+        return list(executor.map(minify, jobs, chunksize=chunksize))
+
+
+class MinifiedSizes:
+
+    """
+    Sizes in bytes(utf-8) of texts before and after minifying, by extension.
+    """
+
+    def __init__(self):
+        self._sizes = {}
+
+    def count(self, ext, text, minified):
+        # minified could be the text, or its size.
+        before, after = self._sizes.get(ext, (0, 0))
+        if not isinstance(minified, int):
+            minified = len(minified.encode('utf-8'))
+        self._sizes[ext] = (before + len(text.encode('utf-8')),
+                            after + minified)
+
+    def report(self, plugin):
+        for ext, (before, after) in sorted(self._sizes.items()):
+            print('{}: {} {} -> {} bytes, {} saved.'.format(
+                plugin, ext[1:], before, after, before - after,
+            ))
@@ -1,22 +1,56 @@
 
 import os
 import re
+import json
+from html import unescape
 from datetime import datetime
-from functools import partial
+from functools import partial, lru_cache
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 import mistune
+import pygments
+from jinja2 import meta
 
 from geekcms.protocol import BasePlugin
 from geekcms.protocol import PluginController as pcl
 from geekcms.protocol import BaseResource
-from geekcms.utils import ShareData
+from geekcms.utils import ShareData, PathResolver
 
 from .assets import (MarkdownFile, ArticleFile, AboutFile, IndexFile,
+                     StaticFileOfThemeSimple,
                      Page, ArticlePage, TimeLinePage,
-                     ArchivePage, AboutPage, IndexPage)
+                     ArchivePage, AboutPage, IndexPage, SearchIndexPage)
+from .instrument import instrument
+from .minify import (MINIFIERS, VERSION as MINIFY_VERSION,
+                     minify_all, MinifiedSizes)
 from .utils import (SyntaxHighlightRenderer, ArticlePageToFileMapping,
-                    template_env, PageForRender, XMLOperation)
+                    template_env, ArticleIndex, ArchiveOperation,
+                    StateCache, content_hash, share_int, share_flag,
+                    ArticleUrlAllocator, AssetManifest, LoadManifest,
+                    SearchDocIdAllocator, atomic_write, get_fork_context)
+
+
+# patterns of meta.py of Python-Markdown, matched with pos and endpos of a
+# line.
+_META_RE = re.compile(r'[ ]{0,3}(?P<key>[A-Za-z0-9_-]+):\s*(?P<value>.*)')
+_META_MORE_RE = re.compile(r'[ ]{4,}(?P<value>.*)')
+_BLANK_RE = re.compile(r'\s*\Z')
+_DATE_RE = re.compile(r'(\d{1,2})/(\d{1,2})/(\d{4})\Z')
+
+
+@lru_cache(maxsize=4096)
+def _parse_date(value):
+    # fast path of datetime.strptime(value, '%d/%m/%Y'), which is still used
+    # for error reporting.
+    match = _DATE_RE.match(value)
+    if match:
+        day, month, year = map(int, match.groups())
+        try:
+            return datetime(year, month, day)
+        except ValueError:
+            pass
+    return datetime.strptime(value, '%d/%m/%Y')
 
 
 class MarkdownProcessor(BasePlugin):
@@ -25,6 +59,8 @@ class MarkdownProcessor(BasePlugin):
     1. Extract meta data.
     2. Generate html from markdown.
     3. Attach meta data and html to resources.
+
+    Results are cached by content hash, unchanged files skip rendering.
     """
 
     plugin = 'md_to_html'
@@ -34,19 +70,58 @@ class MarkdownProcessor(BasePlugin):
     TITLE = 'title'
     DATE = 'date'
 
-    def _extract_meta_from_lines(self, lines):
-        # code of meta.py of Python-Markdown.
-        META_RE =\
-            re.compile(r'^[ ]{0,3}(?P<key>[A-Za-z0-9_-]+):\s*(?P<value>.*)')
-        META_MORE_RE = re.compile(r'^[ ]{4,}(?P<value>.*)')
+    # bump it whenever the output of rendering changes.
+    RENDER_VERSION = '1'
+    CACHE_REL_PATH = 'md_cache'
+
+    PATH_INDEX_REL_PATH = 'md_path_index'
+
+    def _get_cache(self):
+        max_entries = share_int('simple.md_cache_size', 10000)
+        return StateCache(self.CACHE_REL_PATH, max_entries).load()
+
+    def _get_path_index(self):
+        max_entries = share_int('simple.md_cache_size', 10000)
+        return StateCache(self.PATH_INDEX_REL_PATH, max_entries).load()
+
+    def _get_text_hash(self, md_file, path_index):
+        # files marked unchanged by LoadManifest would not be read.
+        indexed = path_index.get(md_file.abs_path)
+        # entries of earlier versions are (signature, hash) pairs.
+        if md_file.status == LoadManifest.UNCHANGED and\
+                isinstance(indexed, str):
+            return indexed
+
+        text_hash = content_hash(md_file.text)
+        path_index.set(md_file.abs_path, text_hash)
+        return text_hash
+
+    def _get_cache_key(self, text_hash):
+        return content_hash(
+            self.RENDER_VERSION,
+            mistune.__version__,
+            pygments.__version__,
+            text_hash,
+        )
 
+    def _extract_meta_from_text(self, text):
+        # code of meta.py of Python-Markdown, lines are located by offsets
+        # rather than splitting the whole text.
         meta = {}
         key = None
-        while lines:
-            line = lines.pop(0)
-            if line.strip() == '':
+        pos = 0
+        text_end = len(text)
+        while pos < text_end:
+            line_end = text.find(os.linesep, pos)
+            if line_end == -1:
+                line_end = next_pos = text_end
+            else:
+                next_pos = line_end + len(os.linesep)
+
+            if _BLANK_RE.match(text, pos, line_end):
+                pos = next_pos
                 break
-            m1 = META_RE.match(line)
+            m1 = _META_RE.match(text, pos, line_end)
             if m1:
                 key = m1.group('key').lower().strip()
                 value = m1.group('value').strip()
@@ -55,14 +130,15 @@ class MarkdownProcessor(BasePlugin):
                 except KeyError:
                     meta[key] = [value]
             else:
-                m2 = META_MORE_RE.match(line)
+                m2 = _META_MORE_RE.match(text, pos, line_end)
                 if m2 and key:
                     # Add another line to existing key
                     meta[key].append(m2.group('value').strip())
                 else:
-                    lines.insert(0, line)
                     break
-        return meta
+            pos = next_pos
+        # pos is the offset of body.
+        return meta, pos
 
     def _check_required_fields(self, meta_data):
         for field in [self.TITLE, self.DATE]:
@@ -71,82 +147,289 @@ class MarkdownProcessor(BasePlugin):
 
     def _process_required_fileds(self, meta_data):
         meta_data[self.TITLE] = meta_data[self.TITLE][0]
-        meta_data[self.DATE] = datetime.strptime(
-            meta_data[self.DATE][0],
-            '%d/%m/%Y',
-        )
+        meta_data[self.DATE] = _parse_date(meta_data[self.DATE][0])
 
     def _extract_meta_data(self, text):
-        lines = text.split(os.linesep)
-        meta_data = self._extract_meta_from_lines(lines)
+        meta_data, body_pos = self._extract_meta_from_text(text)
 
         self._check_required_fields(meta_data)
         self._process_required_fileds(meta_data)
 
-        return meta_data, os.linesep.join(lines)
+        return meta_data, text[body_pos:]
 
     def _generate_html(self, text):
         return self.md.render(text)
 
+    def _render(self, text):
+        meta_data, processed_text = self._extract_meta_data(text)
+        html = self._generate_html(processed_text)
+        return meta_data, html
+
+    def _render_with_path(self, md_file, render, *args):
+        try:
+            return render(*args)
+        except Exception as err:
+            raise Exception(
+                'Failed To Render {}'.format(md_file.abs_path),
+            ) from err
+
+    def _render_files(self, md_files, texts):
+        # number of worker processes, 1 means rendering in current process,
+        # as well as where processes could not be forked.
+        workers = share_int('simple.md_workers', 1)
+        context = get_fork_context()
+        if workers <= 1 or len(texts) <= 1 or context is None:
+            for md_file, text in zip(md_files, texts):
+                yield self._render_with_path(md_file, self._render, text)
+            return
+
+        chunksize = max(1, len(texts) // (workers * 4))
+        with ProcessPoolExecutor(workers, mp_context=context) as executor:
+            # results keep the order of texts.
+            results = executor.map(_render_in_worker, texts,
+                                   chunksize=chunksize)
+            for md_file in md_files:
+                yield self._render_with_path(md_file, next, results)
+
+    @instrument
     @pcl.accept_parameters(
         (pcl.RESOURCES, MarkdownFile),
     )
     def run(self, md_files):
+        cache = self._get_cache()
+        path_index = self._get_path_index()
+        results = {}
+        # collect files missing in cache.
+        missing_files, missing_keys, missing_texts = [], [], []
         for md_file in md_files:
-            meta_data, processed_text = self._extract_meta_data(md_file.text)
-            html = self._generate_html(processed_text)
-            md_file.meta_data = meta_data
-            md_file.html = html
+            text_hash = self._get_text_hash(md_file, path_index)
+            key = self._get_cache_key(text_hash)
+            cached = cache.get(key)
+            if cached is None:
+                missing_files.append(md_file)
+                missing_keys.append(key)
+                missing_texts.append(md_file.text)
+            else:
+                results[md_file] = cached
+
+        rendered = self._render_files(missing_files, missing_texts)
+        for md_file, key, result in zip(missing_files, missing_keys, rendered):
+            cache.set(key, result)
+            results[md_file] = result
+
+        # attach meta data and html.
+        release_text = share_flag('simple.release_text', True)
+        for md_file in md_files:
+            md_file.meta_data, md_file.html = results[md_file]
+            if release_text:
+                md_file.release()
+        for abs_path in LoadManifest.deleted:
+            path_index.remove(abs_path)
+        cache.save()
+        path_index.save()
+        # signatures are saved after the path index, so that a file marked
+        # unchanged always has its hash indexed.
+        LoadManifest.save()
+        print('{}: {} hits, {} misses.'.format(
+            self.plugin, cache.hits, cache.misses,
+        ))
+
+
+def _render_in_worker(text):
+    # executed in worker processes of MarkdownProcessor.
+    return MarkdownProcessor()._render(text)
 
 
 class _TemplateRender:
 
+    # partial renders and rendered snippets shared by all plugins in a build.
+    _template_renders = {}
+    _snippets = {}
+
+    @classmethod
+    def clear_template_renders(cls):
+        _TemplateRender._template_renders.clear()
+        _TemplateRender._snippets.clear()
+
     def _get_url_of_share_data(self, key):
         return '/' + ShareData.get(key)
 
+    def _get_share_fields(self):
+        search_index_url = None
+        if share_flag('simple.search', False):
+            search_index_url = '/{}/'.format(SearchIndexPage.REL_DIR)
+        return {
+            'time_line_url':
+                self._get_url_of_share_data('simple.time_line_page'),
+            'archive_url': self._get_url_of_share_data('simple.archive_page'),
+            'about_url': self._get_url_of_share_data('simple.about_page'),
+            # None means search is disabled.
+            'search_index_url': search_index_url,
+        }
+
+    def _get_template_digest(self, template_name):
+        # digest of sources of the template and templates referenced by it,
+        # along with share fields.
+        key = ('digest', template_name)
+        snippets = _TemplateRender._snippets
+        if key not in snippets:
+            sources = []
+            names = [template_name]
+            while names:
+                name = names.pop()
+                source, _, _ = template_env.loader.get_source(template_env,
+                                                              name)
+                sources.append(source)
+                names.extend(
+                    ref for ref in meta.find_referenced_templates(
+                        template_env.parse(source))
+                    # None means the reference is not static.
+                    if ref is not None
+                )
+            snippets[key] = content_hash(
+                AssetManifest.digest(),
+                json.dumps(self._get_share_fields(), sort_keys=True),
+                *sources
+            )
+        return snippets[key]
+
     def _get_particle_template_render(self, template_name):
+        renders = _TemplateRender._template_renders
+        if template_name not in renders:
+            renders[template_name] = self._create_particle_template_render(
+                template_name,
+            )
+        return renders[template_name]
+
+    def _create_particle_template_render(self, template_name):
         template = template_env.get_template(template_name)
 
-        time_line_url = self._get_url_of_share_data('simple.time_line_page')
-        archive_url = self._get_url_of_share_data('simple.archive_page')
-        about_url = self._get_url_of_share_data('simple.about_page')
-
         partial_render = partial(
             template.render,
-            # share fields.
-            time_line_url=time_line_url,
-            archive_url=archive_url,
-            about_url=about_url,
+            # fingerprinted url of theme static file.
+            asset_url=AssetManifest.asset_url,
+            **self._get_share_fields()
         )
         return partial_render
 
 
+class StaticFileMinifier(BasePlugin):
+
+    """
+    Minify css/js files of theme if minify is true. Minified copies are kept
+    in states/simple/minified, named by content hash of the original ones and
+    the minifier version, and published instead of them. Runs before
+    fingerprint, so that fingerprints are hashes of the published files.
+    """
+
+    plugin = 'minify_static'
+
+    MINIFIED_REL_PATH = 'minified'
+
+    def _get_minified_dir(self):
+        dir_path = os.path.join(
+            PathResolver.theme_state('simple', ensure_exist=True),
+            self.MINIFIED_REL_PATH,
+        )
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        return dir_path
+
+    def _remove_unused(self, minified_dir, static_files):
+        used = set(static_file.processed_abs_path
+                   for static_file in static_files)
+        for name in os.listdir(minified_dir):
+            path = os.path.join(minified_dir, name)
+            if path not in used:
+                os.remove(path)
+
+    @instrument
+    @pcl.accept_parameters(
+        (pcl.RESOURCES, StaticFileOfThemeSimple),
+    )
+    def run(self, static_files):
+        if not share_flag('simple.minify', False):
+            for static_file in static_files:
+                static_file.processed_abs_path = None
+            return
+
+        minified_dir = self._get_minified_dir()
+        sizes = MinifiedSizes()
+        missed = []
+        for static_file in static_files:
+            _, ext = os.path.splitext(static_file.rel_path)
+            if ext not in MINIFIERS:
+                continue
+            text = static_file.text
+            # named by the minifier version as well, so that fingerprints
+            # follow changes of minified results.
+            static_file.processed_abs_path = os.path.join(
+                minified_dir,
+                content_hash(str(MINIFY_VERSION), '\0', text) + ext,
+            )
+            if os.path.exists(static_file.processed_abs_path):
+                sizes.count(ext, text,
+                            os.path.getsize(static_file.processed_abs_path))
+            else:
+                missed.append((static_file, ext))
+
+        results = minify_all(
+            [(ext, static_file.text) for static_file, ext in missed],
+            share_int('simple.minify_workers', 1),
+        )
+        for (static_file, ext), minified in zip(missed, results):
+            atomic_write(static_file.processed_abs_path,
+                         minified.encode('utf-8'))
+            sizes.count(ext, static_file.text, minified)
+
+        self._remove_unused(minified_dir, static_files)
+        sizes.report(self.plugin)
+
+
+class AssetFingerprinter(BasePlugin):
+
+    """
+    Content hashes of published theme static files are inserted into their
+    names in outputs, so they could be cached for a long time. Disabled if
+    fingerprint is false.
+    """
+
+    plugin = 'fingerprint'
+
+    @instrument
+    @pcl.accept_parameters(
+        (pcl.RESOURCES, StaticFileOfThemeSimple),
+    )
+    def run(self, static_files):
+        if not share_flag('simple.fingerprint', False):
+            AssetManifest.clear()
+            return
+        AssetManifest.fingerprint(static_files)
+
+
 class ArticlePageGenerator(BasePlugin, _TemplateRender):
 
     """
     1. Generate rel_path of outputs directory. (simple.article + title)
-    2. Deal with url confilcts.
+    2. Deal with url confilcts, urls are kept across builds.
     3. Register page to article mappings.
     """
 
     plugin = 'gen_article_page'
-
-    def __init__(self):
-        self._unique_rel_paths = []
+    # templates in use, see watch.py.
+    TEMPLATES = ('article.html', 'disqus.js')
 
     def _get_disqus_js(self):
-        js_template = template_env.get_template('disqus.js')
-        return js_template.render(
-            disqus_shortname=ShareData.get('global.disqus_shortname'),
-        )
-
-    def _adjust_conflict_rel_path(self, rel_path):
-        while rel_path in self._unique_rel_paths:
-            rel_path = re.sub(r'.html$', '', rel_path) + 'remove_conflict.html'
-        self._unique_rel_paths.append(rel_path)
-        return rel_path
-
-    def _generate_article_rel_path(self, rel_path_to_inputs):
+        # the snippet never changes in a build.
+        snippets = _TemplateRender._snippets
+        if 'disqus.js' not in snippets:
+            js_template = template_env.get_template('disqus.js')
+            snippets['disqus.js'] = js_template.render(
+                disqus_shortname=ShareData.get('global.disqus_shortname'),
+            )
+        return snippets['disqus.js']
+
+    def _generate_article_rel_path(self, url_allocator, rel_path_to_inputs):
         _, filename = os.path.split(rel_path_to_inputs)
         # generate url base on rel_path of inputs.
         rel_path = os.path.join(
@@ -157,7 +440,7 @@ class ArticlePageGenerator(BasePlugin, _TemplateRender):
         head, _ = os.path.splitext(rel_path)
         rel_path = head + '.html'
         # adjust conflits url.
-        rel_path = self._adjust_conflict_rel_path(rel_path)
+        rel_path = url_allocator.allocate(rel_path_to_inputs, rel_path)
         return rel_path
 
     def _render_html(self, article_file):
@@ -169,19 +452,35 @@ class ArticlePageGenerator(BasePlugin, _TemplateRender):
         )
         return html
 
+    def _generate_article_page(self, article_file, rel_path):
+        page_manager = self.get_manager_bind_with_plugin(ArticlePage)
+        html = self._render_html(article_file)
+        # init ArticlePage.
+        article_page = page_manager.create(html, rel_path)
+        # set mapping.
+        ArticlePageToFileMapping.set_mapping(article_page, article_file)
+        return article_page
+
+    @instrument
     @pcl.accept_parameters(
         (pcl.RESOURCES, ArticleFile),
     )
     def run(self, article_files):
-        page_manager = self.get_manager_bind_with_plugin(ArticlePage)
+        url_allocator = ArticleUrlAllocator().load()
+        url_allocator.retain(
+            article_file.rel_path for article_file in article_files
+        )
+        # allocate urls in a stable order, not the order of loading.
+        rel_paths = {}
+        for article_file in sorted(article_files, key=lambda x: x.rel_path):
+            rel_paths[article_file] = self._generate_article_rel_path(
+                url_allocator,
+                article_file.rel_path,
+            )
+        url_allocator.save()
+
         for article_file in article_files:
-            # generate necessary attrs.
-            rel_path = self._generate_article_rel_path(article_file.rel_path)
-            html = self._render_html(article_file)
-            # init ArticlePage.
-            article_page = page_manager.create(html, rel_path)
-            # set mapping.
-            ArticlePageToFileMapping.set_mapping(article_page, article_file)
+            self._generate_article_page(article_file, rel_paths[article_file])
 
 
 class _SimpleSpecialPageGenerator(_TemplateRender):
@@ -207,7 +506,9 @@ class _SimpleSpecialPageGenerator(_TemplateRender):
 class AboutPageGenerator(BasePlugin, _SimpleSpecialPageGenerator):
 
     plugin = 'gen_about_page'
+    TEMPLATES = ('article.html',)
 
+    @instrument
     @pcl.accept_parameters(
         (pcl.RESOURCES, AboutFile),
     )
@@ -222,7 +523,9 @@ class AboutPageGenerator(BasePlugin, _SimpleSpecialPageGenerator):
 class IndexPageGenerator(BasePlugin, _SimpleSpecialPageGenerator):
 
     plugin = 'gen_index_page'
+    TEMPLATES = ('article.html',)
 
+    @instrument
     @pcl.accept_parameters(
         (pcl.RESOURCES, IndexFile),
     )
@@ -234,56 +537,91 @@ class IndexPageGenerator(BasePlugin, _SimpleSpecialPageGenerator):
         )
 
 
-class _PageForRenderGenerator:
-
-    def _generate_sorted_pages(self, article_pages, reverse=False):
-        pages = []
-        for article_page in article_pages:
-            pages.append(PageForRender(article_page))
+class TimeLinePageGenerator(BasePlugin, _TemplateRender):
 
-        return sorted(pages, key=lambda x: x.post_time, reverse=reverse)
+    """
+    Articles sorted by post time are split into pages of
+    time_line_page_size(0 means a single page). Rendered pages are cached by
+    digest of their contents and templates, so pages not affected by changed
+    articles are not rendered again.
+    """
 
+    plugin = 'gen_time_line_page'
+    TEMPLATES = ('time_line.html',)
+
+    CACHE_REL_PATH = 'time_line_cache'
+
+    def _split_pages(self, pages):
+        page_size = share_int('simple.time_line_page_size', 0)
+        if page_size <= 0:
+            return [pages]
+        return [pages[index:index + page_size]
+                for index in range(0, len(pages), page_size)] or [[]]
+
+    def _get_cache_key(self, template_digest, page_number, last_page_number,
+                       pages):
+        return content_hash(
+            template_digest,
+            '{}/{}'.format(page_number, last_page_number),
+            *('\0'.join([page.url, page.title, page.post_time, ''])
+              for page in pages)
+        )
 
-class TimeLinePageGenerator(BasePlugin,
-                            _TemplateRender,
-                            _PageForRenderGenerator):
+    def _render_html(self, page_number, last_page_number, pages):
+        prev_url = next_url = None
+        if page_number > 1:
+            prev_url = TimeLinePage.get_url(page_number - 1)
+        if page_number < last_page_number:
+            next_url = TimeLinePage.get_url(page_number + 1)
 
-    plugin = 'gen_time_line_page'
+        template_render = self._get_particle_template_render('time_line.html')
+        return template_render(pages=pages,
+                               title='TimeLine',
+                               page_number=page_number,
+                               prev_url=prev_url,
+                               next_url=next_url)
 
+    @instrument
     @pcl.accept_parameters(
         (pcl.PRODUCTS, ArticlePage),
     )
     def run(self, article_pages):
-
-        template_render = self._get_particle_template_render('time_line.html')
-        pages = self._generate_sorted_pages(article_pages, True)
-        html = template_render(pages=pages,
-                               title='TimeLine')
-
+        chunks = self._split_pages(ArticleIndex.newest_first(article_pages))
+        template_digest = self._get_template_digest('time_line.html')
+        cache = StateCache(self.CACHE_REL_PATH, 2 * len(chunks)).load()
         page_manager = self.get_manager_bind_with_plugin(TimeLinePage)
-        page_manager.create(html)
 
+        for index, pages in enumerate(chunks):
+            page_number = index + 1
+            key = self._get_cache_key(template_digest,
+                                      page_number, len(chunks), pages)
+            html = cache.get(key)
+            if html is None:
+                html = self._render_html(page_number, len(chunks), pages)
+                cache.set(key, html)
+            page_manager.create(html, page_number)
+        cache.save()
 
-class ArchivePageGenerator(BasePlugin,
-                           _TemplateRender,
-                           _PageForRenderGenerator):
+
+class ArchivePageGenerator(BasePlugin, _TemplateRender):
 
     plugin = 'gen_archive_page'
+    TEMPLATES = ('archive.html',)
 
-    def _construct_ordered_paths(self, pages, old_xml):
+    def _construct_ordered_paths(self, pages, old_paths):
         ordered_paths = []
         raw_paths = [page.input_rel_path for page in pages]
+        remaining_paths = set(raw_paths)
 
-        for node in old_xml.iter():
-            if node.tag != XMLOperation.PAGE:
-                continue
-            path = node.attrib['path']
-            if path in raw_paths:
+        for path in old_paths:
+            if path in remaining_paths:
                 # avaliable path
                 ordered_paths.append(path)
-                raw_paths.remove(path)
+                remaining_paths.remove(path)
         # extend new pages.
-        ordered_paths.extend(raw_paths)
+        ordered_paths.extend(
+            path for path in raw_paths if path in remaining_paths
+        )
         return ordered_paths
 
     def _get_common_prefix(self, ordered_paths):
@@ -295,14 +633,15 @@ class ArchivePageGenerator(BasePlugin,
         # which is the root of the article tree.
         # leaf of the article tree represents article, while dir
         # represents topic.
-        common_prefix = os.path.commonprefix(dir_paths)
-        if not common_prefix.endswith('/'):
+        common_prefix = os.path.commonpath(dir_paths)
+        if common_prefix:
             common_prefix += '/'
-        if '/' not in re.sub(common_prefix, '', ordered_paths[0]):
+        if '/' not in ordered_paths[0][len(common_prefix):]:
             # there is only a single topic.
             # go to an upper layer
             common_prefix, _ = os.path.split(common_prefix.rstrip('/'))
-            common_prefix += '/'
+            if common_prefix:
+                common_prefix += '/'
         return common_prefix
 
     def _expand_article_tree(self, article_tree, dirs):
@@ -327,7 +666,8 @@ class ArchivePageGenerator(BasePlugin,
         # generate article_tree.
         article_tree = OrderedDict()
         for path in ordered_paths:
-            rel_path = re.sub(common_prefix, '', path)
+            # all paths start with common_prefix.
+            rel_path = path[len(common_prefix):]
             head, _ = os.path.split(rel_path)
             dirs = head.split('/')
 
@@ -342,25 +682,144 @@ class ArchivePageGenerator(BasePlugin,
             })
         return article_tree
 
+    @instrument
     @pcl.accept_parameters(
         (pcl.PRODUCTS, ArticlePage),
     )
     def run(self, article_pages):
-        xml_operator = XMLOperation()
-        pages = self._generate_sorted_pages(article_pages)
+        archive_operator = ArchiveOperation()
+        pages = ArticleIndex.oldest_first(article_pages)
 
-        old_xml = xml_operator.load_xml()
-        ordered_paths = self._construct_ordered_paths(pages, old_xml)
+        old_paths = archive_operator.load_ordered_paths()
+        ordered_paths = self._construct_ordered_paths(pages, old_paths)
         common_prefix = self._get_common_prefix(ordered_paths)
         article_tree = self._construct_article_tree(
             pages,
             ordered_paths,
             common_prefix,
         )
-        xml_operator.generate_xml(article_tree)
+        archive_operator.save(article_tree)
 
         template_render = self._get_particle_template_render('archive.html')
         page_manager = self.get_manager_bind_with_plugin(ArchivePage)
         html = template_render(article_tree=article_tree,
                                title='Archives')
         page_manager.create(html)
+
+
+class SearchIndexGenerator(BasePlugin):
+
+    """
+    Inverted index of articles for client side search(static/js/search.js),
+    if search is true. Terms are words of ascii letters and digits, and
+    single CJK characters, of titles and rendered html. Postings of a term
+    are (document id, score) pairs, and terms of titles weigh more.
+
+    1. search/docs.json: documents(url, title, post time) by id, and names of
+    shards. Ids are kept across builds, see SearchDocIdAllocator.
+    2. search/<shard>.json: postings of terms, sharded by the first character
+    of terms, see _get_shard_name.
+
+    Terms of every article are cached by content hash in
+    states/simple/search_cache, unchanged articles are not tokenized again.
+    """
+
+    plugin = 'gen_search_index'
+
+    VERSION = 2
+    # bumped whenever _get_terms changes, terms are cached by it.
+    TOKENIZER_VERSION = 1
+    CACHE_REL_PATH = 'search_cache'
+    TITLE_WEIGHT = 5
+    MAX_TERM_LENGTH = 32
+
+    _TAG_RE = re.compile(r'<[^>]*>')
+    _TERM_RE = re.compile(
+        r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]|[a-z0-9]+'
+    )
+
+    def _tokenize(self, text):
+        for term in self._TERM_RE.findall(text.lower()):
+            # single ascii character is too common to be useful.
+            if len(term) == 1 and term.isascii():
+                continue
+            yield term[:self.MAX_TERM_LENGTH]
+
+    def _get_terms(self, title, html):
+        terms = {}
+        for term in self._tokenize(unescape(self._TAG_RE.sub(' ', html))):
+            terms[term] = terms.get(term, 0) + 1
+        for term in self._tokenize(title):
+            terms[term] = terms.get(term, 0) + self.TITLE_WEIGHT
+        return terms
+
+    def _get_shard_name(self, term):
+        # ascii terms are sharded by their first character, CJK characters are
+        # grouped by blocks of 256 code points.
+        first = term[0]
+        if first.isascii():
+            return first
+        return 'u{:x}'.format(ord(first) >> 8)
+
+    def _dumps(self, data):
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'),
+                          sort_keys=True)
+
+    @instrument
+    @pcl.accept_parameters(
+        (pcl.PRODUCTS, ArticlePage),
+    )
+    def run(self, article_pages):
+        if not share_flag('simple.search', False):
+            return
+
+        cache = StateCache(self.CACHE_REL_PATH,
+                           2 * len(article_pages) + 64).load()
+        article_files = {
+            article_page.url: ArticlePageToFileMapping.get_mapping(
+                article_page,
+            )
+            for article_page in article_pages
+        }
+
+        id_allocator = SearchDocIdAllocator().load()
+        id_allocator.retain(
+            article_file.rel_path for article_file in article_files.values()
+        )
+
+        docs = {}
+        shards = {}
+        for page in ArticleIndex.newest_first(article_pages):
+            article_file = article_files[page.url]
+            doc_id = id_allocator.allocate(article_file.rel_path)
+            docs[doc_id] = [page.url, page.title, page.post_time]
+
+            html = article_file.html
+            # title could not contain NUL, which delimits it from html.
+            key = content_hash(str(self.TOKENIZER_VERSION), '\0',
+                               page.title, '\0', html)
+            terms = cache.get(key)
+            if terms is None:
+                terms = self._get_terms(page.title, html)
+                cache.set(key, terms)
+
+            for term, score in terms.items():
+                shard = shards.setdefault(self._get_shard_name(term), {})
+                shard.setdefault(term, []).append([doc_id, score])
+        cache.save()
+        id_allocator.save()
+
+        page_manager = self.get_manager_bind_with_plugin(SearchIndexPage)
+        page_manager.create(
+            self._dumps({
+                'version': self.VERSION,
+                'docs': docs,
+                'shards': sorted(shards),
+            }),
+            'docs',
+        )
+        for name, postings in shards.items():
+            for posting in postings.values():
+                # higher score first.
+                posting.sort(key=lambda pair: -pair[1])
+            page_manager.create(self._dumps(postings), name)
@@ -0,0 +1,290 @@
+"""
+Usage:
+    geekcms serve [options]
+
+Options:
+    --host=<host>         Host to listen on. [default: 127.0.0.1]
+    --port=<port>         Port to listen on. [default: 8000]
+    --interval=<seconds>  Seconds between two scans of files. [default: 0.2]
+
+"""
+
+import os
+import gzip
+import asyncio
+import hashlib
+import mimetypes
+import traceback
+import urllib.parse
+from email.utils import formatdate
+
+from geekcms.protocol import BaseExtendedProcedure
+
+from .assets import Page, StaticFile
+from .watch import WarmBuild, _take_snapshot, _diff_snapshots
+
+
+class _Entry:
+
+    """
+    Response body of a single file, along with its ETag and gzipped body.
+    """
+
+    __slots__ = ('source', 'body', 'etag', 'content_type', '_gzip_body')
+
+    COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/xml',
+                          'application/json', 'image/svg+xml')
+
+    def __init__(self, rel_path, body, source=None):
+        # source is the object the body comes from, for detecting changes.
+        self.source = source
+        self.body = body
+        self.etag = '"{}"'.format(hashlib.sha1(body).hexdigest()[:20])
+        content_type, _ = mimetypes.guess_type(rel_path)
+        content_type = content_type or 'application/octet-stream'
+        if content_type.startswith('text/'):
+            content_type += '; charset=utf-8'
+        self.content_type = content_type
+        self._gzip_body = None
+
+    @property
+    def compressible(self):
+        return self.content_type.startswith(self.COMPRESSIBLE_TYPES)
+
+    @property
+    def gzip_body(self):
+        if self._gzip_body is None:
+            self._gzip_body = gzip.compress(self.body, mtime=0)
+        return self._gzip_body
+
+
+class PageMap:
+
+    """
+    Outputs kept in memory. Pages are mapped from rel_path to their encoded
+    text, static files from rel_path to paths of the files published(sources
+    or their minified copies), which are read once and reloaded when changed.
+    A rebuilt map is swapped in as a whole, so requests never see a
+    half-updated site.
+    """
+
+    def __init__(self):
+        self._maps = ({}, {})
+        self._static_entries = {}
+
+    def swap(self, pages, static_files):
+        old_pages, _ = self._maps
+        new_pages = {}
+        for page in pages:
+            entry = old_pages.get(page.rel_path, None)
+            # reuse entries(and their gzipped bodies) of unchanged pages.
+            if entry is None or entry.source != page.text:
+                entry = _Entry(page.rel_path, page.text.encode('utf-8'),
+                               page.text)
+            new_pages[page.rel_path] = entry
+
+        new_static_files = {}
+        for static_file in static_files:
+            new_static_files[static_file.output_rel_path] =\
+                static_file.publish_abs_path
+        self._maps = (new_pages, new_static_files)
+
+    def _get_static_entry(self, rel_path, abs_path):
+        try:
+            stat = os.stat(abs_path)
+        except OSError:
+            return None
+        signature = (abs_path, stat.st_mtime_ns, stat.st_size)
+        entry = self._static_entries.get(rel_path, None)
+        if entry is None or entry.source != signature:
+            with open(abs_path, 'rb') as f:
+                entry = _Entry(rel_path, f.read(), signature)
+            self._static_entries[rel_path] = entry
+        return entry
+
+    def get(self, rel_path):
+        pages, static_files = self._maps
+        if rel_path in pages:
+            return pages[rel_path]
+        if rel_path in static_files:
+            return self._get_static_entry(rel_path, static_files[rel_path])
+        return None
+
+    def __len__(self):
+        pages, static_files = self._maps
+        return len(pages) + len(static_files)
+
+
+class _HTTPHandler:
+
+    REASONS = {
+        200: 'OK',
+        304: 'Not Modified',
+        400: 'Bad Request',
+        404: 'Not Found',
+        405: 'Method Not Allowed',
+    }
+
+    def __init__(self, page_map):
+        self.page_map = page_map
+
+    def _get_rel_path(self, target):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+        rel_path = path.lstrip('/')
+        if not rel_path or rel_path.endswith('/'):
+            rel_path += 'index.html'
+        return rel_path
+
+    def _respond(self, method, target, headers):
+        # return status, headers and body.
+        if method not in ('GET', 'HEAD'):
+            return 405, [('Allow', 'GET, HEAD')], b''
+
+        entry = self.page_map.get(self._get_rel_path(target))
+        if entry is None:
+            return 404, [('Content-Type', 'text/plain')], b'Not Found'
+
+        response_headers = [
+            ('ETag', entry.etag),
+            ('Cache-Control', 'no-cache'),
+        ]
+        if entry.compressible:
+            response_headers.append(('Vary', 'Accept-Encoding'))
+        if_none_match = headers.get('if-none-match', '')
+        if entry.etag in [tag.strip() for tag in if_none_match.split(',')]:
+            return 304, response_headers, b''
+
+        body = entry.body
+        if entry.compressible and\
+                'gzip' in headers.get('accept-encoding', ''):
+            body = entry.gzip_body
+            response_headers.append(('Content-Encoding', 'gzip'))
+        response_headers.append(('Content-Type', entry.content_type))
+        return 200, response_headers, body
+
+    def _write_response(self, writer, method, status, headers, body,
+                        keep_alive):
+        lines = ['HTTP/1.1 {} {}'.format(status, self.REASONS[status])]
+        headers = headers + [
+            ('Date', formatdate(usegmt=True)),
+            ('Content-Length', str(len(body))),
+            ('Connection', 'keep-alive' if keep_alive else 'close'),
+        ]
+        lines.extend('{}: {}'.format(name, value) for name, value in headers)
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if method != 'HEAD':
+            writer.write(body)
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return request_line.decode('latin-1').split(), headers
+
+    async def __call__(self, reader, writer):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                request_line, headers = request
+                if len(request_line) != 3:
+                    self._write_response(writer, 'GET', 400, [], b'', False)
+                    break
+
+                method, target, version = request_line
+                keep_alive = (
+                    version == 'HTTP/1.1' and
+                    headers.get('connection', '').lower() != 'close' and
+                    # bodies of requests are not read.
+                    method in ('GET', 'HEAD')
+                )
+                status, response_headers, body = self._respond(
+                    method, target, headers,
+                )
+                self._write_response(writer, method, status,
+                                     response_headers, body, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+class Server(BaseExtendedProcedure):
+
+    def get_command_and_explanation(self):
+        return ('serve',
+                'Build in memory and serve the site, rebuild on changes.')
+
+    def get_doc(self):
+        return __doc__
+
+    def _swap_in(self, page_map):
+        page_map.swap(Page.objects.values(), StaticFile.objects.values())
+
+    def _rebuild(self, warm_build, page_map, changed_paths):
+        # executed in a worker thread, requests are served meanwhile.
+        warm_build.rebuild(changed_paths)
+        self._swap_in(page_map)
+
+    async def _watch(self, warm_build, page_map, interval):
+        loop = asyncio.get_running_loop()
+        watched_dirs = warm_build.get_watched_dirs()
+        snapshot = await loop.run_in_executor(None, _take_snapshot,
+                                              watched_dirs)
+        while True:
+            await asyncio.sleep(interval)
+            new_snapshot = await loop.run_in_executor(None, _take_snapshot,
+                                                      watched_dirs)
+            changed_paths = _diff_snapshots(snapshot, new_snapshot)
+            if not changed_paths:
+                continue
+            snapshot = new_snapshot
+
+            start = loop.time()
+            try:
+                await loop.run_in_executor(None, self._rebuild, warm_build,
+                                           page_map, changed_paths)
+            except Exception:
+                # keep serving the last successful build.
+                traceback.print_exc()
+                continue
+            print('Rebuilt {} changed file(s) in {:.3f}s.'.format(
+                len(changed_paths),
+                loop.time() - start,
+            ))
+
+    async def _serve(self, host, port, interval):
+        # writing stages are skipped, nothing is written to outputs.
+        warm_build = WarmBuild(publish=False)
+        warm_build.run_all()
+        page_map = PageMap()
+        self._swap_in(page_map)
+
+        server = await asyncio.start_server(_HTTPHandler(page_map),
+                                            host, port)
+        print('Serving {} files on http://{}:{}/'.format(
+            len(page_map), host, port,
+        ))
+        async with server:
+            await self._watch(warm_build, page_map, interval)
+
+    def run(self, args):
+        try:
+            asyncio.run(self._serve(
+                args['--host'],
+                int(args['--port']),
+                float(args['--interval']),
+            ))
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,119 @@
+// Client side search over the index generated by gen_search_index.
+// Documents are fetched on first input, shards of terms on demand.
+(function () {
+    'use strict';
+
+    var TERM_RE = /[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]|[a-z0-9]+/g;
+    var MAX_TERM_LENGTH = 32;
+    var MAX_RESULTS = 20;
+
+    var form = document.getElementById('search-form');
+    var results = document.getElementById('search-results');
+    if (!form || !results || !window.fetch) {
+        return;
+    }
+    var input = form.querySelector('input');
+    var indexUrl = form.getAttribute('data-index');
+    var docs = null;
+    var shards = {};
+
+    function fetchJSON(name) {
+        return fetch(indexUrl + name + '.json').then(function (response) {
+            return response.json();
+        });
+    }
+
+    // same as SearchIndexGenerator._tokenize.
+    function tokenize(text) {
+        var terms = text.toLowerCase().match(TERM_RE) || [];
+        return terms.filter(function (term) {
+            return term.length > 1 || term.charCodeAt(0) > 127;
+        }).map(function (term) {
+            return term.slice(0, MAX_TERM_LENGTH);
+        });
+    }
+
+    // same as SearchIndexGenerator._get_shard_name.
+    function shardName(term) {
+        var code = term.charCodeAt(0);
+        return code < 128 ? term[0] : 'u' + (code >> 8).toString(16);
+    }
+
+    function loadDocs() {
+        if (!docs) {
+            docs = fetchJSON('docs');
+        }
+        return docs;
+    }
+
+    function loadPostings(term, index) {
+        var name = shardName(term);
+        if (index.shards.indexOf(name) < 0) {
+            return Promise.resolve([]);
+        }
+        if (!shards[name]) {
+            shards[name] = fetchJSON(name);
+        }
+        return shards[name].then(function (shard) {
+            return shard[term] || [];
+        });
+    }
+
+    function render(index, scores) {
+        // ids are not ordered by time, newer documents win ties.
+        var ids = Object.keys(scores).sort(function (a, b) {
+            if (scores[a] !== scores[b]) {
+                return scores[b] - scores[a];
+            }
+            return index.docs[b][2] < index.docs[a][2] ? -1 : 1;
+        }).slice(0, MAX_RESULTS);
+        results.innerHTML = '';
+        ids.forEach(function (id) {
+            var doc = index.docs[id];
+            var item = document.createElement('li');
+            var link = document.createElement('a');
+            link.href = doc[0];
+            link.textContent = doc[1] + ' (' + doc[2] + ')';
+            item.appendChild(link);
+            results.appendChild(item);
+        });
+    }
+
+    function search(query) {
+        var terms = tokenize(query);
+        if (!terms.length) {
+            results.innerHTML = '';
+            return;
+        }
+        loadDocs().then(function (index) {
+            return Promise.all(terms.map(function (term) {
+                return loadPostings(term, index);
+            })).then(function (postingsOfTerms) {
+                // documents containing every term, scores are summed.
+                var scores = null;
+                postingsOfTerms.forEach(function (postings) {
+                    var next = {};
+                    postings.forEach(function (pair) {
+                        if (scores === null) {
+                            next[pair[0]] = pair[1];
+                        } else if (pair[0] in scores) {
+                            next[pair[0]] = scores[pair[0]] + pair[1];
+                        }
+                    });
+                    scores = next;
+                });
+                if (input.value === query) {
+                    render(index, scores);
+                }
+            });
+        });
+    }
+
+    form.addEventListener('submit', function (event) {
+        event.preventDefault();
+        search(input.value);
+    });
+    input.addEventListener('input', function () {
+        search(input.value);
+    });
+})();
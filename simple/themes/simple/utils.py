@@ -1,16 +1,26 @@
 
 import os
+import sys
+import json
+import mmap
+import pickle
+import hashlib
+import multiprocessing
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
+from itertools import groupby
+from operator import attrgetter
+from collections import OrderedDict
 
 import mistune
 
 from pygments import highlight
 from pygments.lexers import get_lexer_by_name
+from pygments.util import ClassNotFound
 from pygments.formatters import HtmlFormatter
 
 from jinja2 import Environment
 from jinja2 import FileSystemLoader
+from jinja2 import FileSystemBytecodeCache
 
 from geekcms.utils import PathResolver, ShareData
 
@@ -27,14 +37,606 @@ AVALIABLE_MD_EXTENSIONS = [
 ]
 
 
+def share_int(key, default):
+    val = ShareData.get(key)
+    if val is None:
+        return default
+    return int(val)
+
+
+def share_flag(key, default):
+    val = ShareData.get(key)
+    if val is None:
+        return default
+    return val.strip().lower() in ('1', 'yes', 'true', 'on')
+
+
+def atomic_write(path, data):
+    # write to a temporary file of the same directory, then rename it, so that
+    # a crashed build never leaves a truncated file behind.
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    with open(tmp_path, mode) as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def content_hash(*parts):
+    sha1 = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        sha1.update(part)
+    return sha1.hexdigest()
+
+
+def file_hash(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size > chunk_size:
+            # hash large files through memory mapping, without copies.
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                sha1.update(mapped)
+        else:
+            sha1.update(f.read())
+    return sha1.hexdigest()
+
+
+def get_fork_context():
+    # worker processes rely on module state inherited by fork, such as the
+    # project path and template_env, which spawned processes would not have.
+    # None if fork is not available(Windows) or not safe(macOS).
+    if sys.platform == 'darwin' or\
+            'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    return multiprocessing.get_context('fork')
+
+
+class HighlightRegistry:
+
+    """
+    Shared lexers, formatter and highlighted results of code blocks.
+    """
+
+    MAX_RESULTS = 1024
+
+    _lexers = {}
+    _formatter = None
+    _results = OrderedDict()
+
+    @classmethod
+    def get_lexer(cls, lang):
+        # None represents unknown language.
+        if lang not in cls._lexers:
+            try:
+                lexer = get_lexer_by_name(lang, stripall=True)
+            except ClassNotFound:
+                lexer = None
+            cls._lexers[lang] = lexer
+        return cls._lexers[lang]
+
+    @classmethod
+    def get_formatter(cls):
+        if cls._formatter is None:
+            cls._formatter = HtmlFormatter()
+        return cls._formatter
+
+    @classmethod
+    def highlight(cls, code, lang):
+        lexer = cls.get_lexer(lang)
+        if lexer is None:
+            return None
+
+        key = (lang, content_hash(code))
+        if key in cls._results:
+            cls._results.move_to_end(key)
+            return cls._results[key]
+
+        result = highlight(code, lexer, cls.get_formatter())
+        cls._results[key] = result
+        if len(cls._results) > cls.MAX_RESULTS:
+            cls._results.popitem(last=False)
+        return result
+
+
 class SyntaxHighlightRenderer(mistune.Renderer):
     def block_code(self, code, lang):
-        if not lang:
+        html = HighlightRegistry.highlight(code, lang) if lang else None
+        if html is None:
             return '\n<pre><code>%s</code></pre>\n' % \
                 mistune.escape(code)
-        lexer = get_lexer_by_name(lang, stripall=True)
-        formatter = HtmlFormatter()
-        return highlight(code, lexer, formatter)
+        return html
+
+
+class StateCache:
+
+    """
+    LRU mapping persisted in the state directory of theme simple. The file is
+    rewritten only if entries are set, removed or evicted, reordering by hits
+    alone is not saved.
+    """
+
+    def __init__(self, rel_path, max_entries):
+        self.rel_path = rel_path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._dirty = False
+
+    def _get_abs_path(self):
+        return os.path.join(
+            PathResolver.theme_state('simple', ensure_exist=True),
+            self.rel_path,
+        )
+
+    def load(self):
+        try:
+            with open(self._get_abs_path(), 'rb') as f:
+                entries = pickle.load(f)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            entries = OrderedDict()
+        self._entries = entries
+        self._dirty = False
+        return self
+
+    def save(self):
+        # evict least recently used entries.
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._dirty = True
+        if not self._dirty:
+            return
+        atomic_write(
+            self._get_abs_path(),
+            pickle.dumps(self._entries, pickle.HIGHEST_PROTOCOL),
+        )
+        self._dirty = False
+
+    def get(self, key):
+        try:
+            val = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return val
+
+    def set(self, key, val):
+        self._entries[key] = val
+        self._entries.move_to_end(key)
+        self._dirty = True
+
+    def remove(self, key):
+        if key in self._entries:
+            del self._entries[key]
+            self._dirty = True
+
+
+class LoadManifest:
+
+    """
+    Stat signatures of loaded files, persisted in the state directory of theme
+    simple, in order to mark the status of resources.
+    """
+
+    UNCHANGED = 'unchanged'
+    CHANGED = 'changed'
+    ADDED = 'added'
+    DELETED = 'deleted'
+
+    MANIFEST_REL_PATH = 'load_manifest'
+
+    _old_signatures = None
+    _new_signatures = {}
+    _scanned_dirs = []
+    deleted = []
+
+    @classmethod
+    def _get_abs_path(cls):
+        return os.path.join(
+            PathResolver.theme_state('simple', ensure_exist=True),
+            cls.MANIFEST_REL_PATH,
+        )
+
+    @classmethod
+    def _ensure_loaded(cls):
+        if cls._old_signatures is not None:
+            return
+        try:
+            with open(cls._get_abs_path()) as f:
+                signatures = json.load(f)
+        except (OSError, ValueError):
+            signatures = {}
+        cls._old_signatures = {
+            path: tuple(signature)
+            for path, signature in signatures.items()
+        }
+
+    @classmethod
+    def reset(cls):
+        cls._old_signatures = None
+        cls._new_signatures = {}
+        cls._scanned_dirs = []
+        cls.deleted = []
+
+    @staticmethod
+    def get_signature(stat):
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    @classmethod
+    def update(cls, abs_path, signature):
+        cls._ensure_loaded()
+        cls._new_signatures[abs_path] = signature
+        old_signature = cls._old_signatures.get(abs_path, None)
+        if old_signature is None:
+            return cls.ADDED
+        elif old_signature != signature:
+            return cls.CHANGED
+        else:
+            return cls.UNCHANGED
+
+    @classmethod
+    def _in_dir(cls, path, dir_path):
+        return path.startswith(os.path.join(dir_path, ''))
+
+    @classmethod
+    def finish_dir(cls, dir_path):
+        cls._ensure_loaded()
+        cls._scanned_dirs.append(dir_path)
+        for path in cls._old_signatures:
+            if cls._in_dir(path, dir_path)\
+                    and path not in cls._new_signatures:
+                cls.deleted.append(path)
+
+    @classmethod
+    def save(cls):
+        cls._ensure_loaded()
+        # keep signatures of directories not scanned in this build.
+        signatures = {}
+        for path, signature in cls._old_signatures.items():
+            if not any(cls._in_dir(path, dir_path)
+                       for dir_path in cls._scanned_dirs):
+                signatures[path] = signature
+        signatures.update(cls._new_signatures)
+        atomic_write(cls._get_abs_path(), json.dumps(signatures))
+
+
+class OutputManifest:
+
+    """
+    Digests and sizes(and mtimes of sources of static files) of files written
+    to outputs directory, persisted in the state directory of theme simple.
+    Paths are relative to outputs directory.
+    """
+
+    MANIFEST_REL_PATH = 'output_manifest'
+
+    _entries = None
+
+    @classmethod
+    def _get_abs_path(cls):
+        return os.path.join(
+            PathResolver.theme_state('simple', ensure_exist=True),
+            cls.MANIFEST_REL_PATH,
+        )
+
+    @classmethod
+    def _ensure_loaded(cls):
+        if cls._entries is not None:
+            return
+        try:
+            with open(cls._get_abs_path()) as f:
+                cls._entries = json.load(f)
+        except (OSError, ValueError):
+            cls._entries = {}
+
+    @classmethod
+    def reset(cls):
+        cls._entries = None
+
+    @classmethod
+    def paths(cls):
+        cls._ensure_loaded()
+        return list(cls._entries)
+
+    @classmethod
+    def is_unchanged(cls, rel_path, digest):
+        cls._ensure_loaded()
+        entry = cls._entries.get(rel_path, None)
+        if entry is None or entry[0] != digest:
+            return False
+        # make sure the file on disk has not been removed or modified.
+        try:
+            size = os.path.getsize(os.path.join(PathResolver.outputs(),
+                                                rel_path))
+        except OSError:
+            return False
+        return size == entry[1]
+
+    @classmethod
+    def is_recorded(cls, rel_path, size, mtime_ns):
+        # whether the file was recorded with the same size and mtime.
+        cls._ensure_loaded()
+        entry = cls._entries.get(rel_path, None)
+        return entry is not None and entry[1:] == [size, mtime_ns]
+
+    @classmethod
+    def record(cls, rel_path, digest, size, mtime_ns=None):
+        cls._ensure_loaded()
+        entry = [digest, size]
+        if mtime_ns is not None:
+            entry.append(mtime_ns)
+        cls._entries[rel_path] = entry
+        OutputChanges.add(rel_path)
+
+    @classmethod
+    def remove(cls, rel_path):
+        cls._ensure_loaded()
+        cls._entries.pop(rel_path, None)
+        OutputChanges.add(rel_path)
+
+    @classmethod
+    def save(cls):
+        cls._ensure_loaded()
+        atomic_write(cls._get_abs_path(), json.dumps(cls._entries))
+        OutputChanges.save()
+
+
+class OutputChanges:
+
+    """
+    Paths of outputs written or deleted since the last upload, merged across
+    builds and persisted in the state directory of theme simple, so that
+    publishers(gitupload) could stage only changed files. 'full' means any
+    file might have been changed, since outputs directory was cleaned up.
+    """
+
+    CHANGES_REL_PATH = 'output_changes'
+
+    _paths = set()
+    _full = False
+
+    @classmethod
+    def _get_abs_path(cls):
+        return os.path.join(
+            PathResolver.theme_state('simple', ensure_exist=True),
+            cls.CHANGES_REL_PATH,
+        )
+
+    @classmethod
+    def add(cls, rel_path):
+        cls._paths.add(rel_path)
+
+    @classmethod
+    def mark_full(cls):
+        cls._full = True
+
+    @classmethod
+    def save(cls):
+        if not cls._paths and not cls._full:
+            return
+        try:
+            with open(cls._get_abs_path()) as f:
+                changes = json.load(f)
+        except (OSError, ValueError):
+            changes = {'full': False, 'paths': []}
+        changes['full'] = changes['full'] or cls._full
+        changes['paths'] = sorted(cls._paths.union(changes['paths']))
+        atomic_write(cls._get_abs_path(), json.dumps(changes))
+        cls._paths = set()
+        cls._full = False
+
+
+class AssetManifest:
+
+    """
+    Fingerprinted paths of theme static files in outputs, such as
+    static/css/github.<hash>.css of static/css/github.css, which are exposed to
+    templates by asset_url. Digests are of the published files, and persisted
+    along with stat signatures of sources, so unchanged files are not hashed
+    again, and keep their hashes.
+    """
+
+    STATE_REL_PATH = 'asset_manifest'
+    HASH_LENGTH = 12
+
+    # rel_path -> fingerprinted rel_path.
+    _entries = {}
+
+    @classmethod
+    def _get_abs_path(cls):
+        return os.path.join(
+            PathResolver.theme_state('simple', ensure_exist=True),
+            cls.STATE_REL_PATH,
+        )
+
+    @classmethod
+    def _load_digests(cls):
+        # published abs_path -> (signature, digest).
+        try:
+            with open(cls._get_abs_path()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @classmethod
+    def _fingerprint_rel_path(cls, rel_path, digest):
+        root, ext = os.path.splitext(rel_path)
+        return '{}.{}{}'.format(root, digest[:cls.HASH_LENGTH], ext)
+
+    @classmethod
+    def fingerprint(cls, static_files):
+        old_digests = cls._load_digests()
+        digests = {}
+        entries = {}
+        for static_file in static_files:
+            # minified copies are named by contents of their sources, so
+            # signatures of sources still tell changes of published files.
+            abs_path = static_file.publish_abs_path
+            signature = list(static_file.signature)
+            old = old_digests.get(abs_path, None)
+            if old is not None and old[0] == signature:
+                digest = old[1]
+            else:
+                digest = file_hash(abs_path)
+            digests[abs_path] = [signature, digest]
+            entries[static_file.rel_path] = cls._fingerprint_rel_path(
+                static_file.rel_path,
+                digest,
+            )
+        cls._entries = entries
+        if digests != old_digests:
+            atomic_write(cls._get_abs_path(), json.dumps(digests))
+
+    @classmethod
+    def clear(cls):
+        cls._entries = {}
+
+    @classmethod
+    def get_rel_path(cls, rel_path):
+        return cls._entries.get(rel_path, rel_path)
+
+    @classmethod
+    def asset_url(cls, rel_path):
+        return '/' + cls.get_rel_path(rel_path)
+
+    @classmethod
+    def digest(cls):
+        return content_hash(json.dumps(cls._entries, sort_keys=True))
+
+
+class JSONState:
+
+    """
+    Json document persisted in the state directory of theme simple, located by
+    STATE_REL_PATH of subclasses.
+    """
+
+    STATE_REL_PATH = None
+
+    def _get_abs_path(self):
+        return os.path.join(
+            PathResolver.theme_state('simple', ensure_exist=True),
+            self.STATE_REL_PATH,
+        )
+
+    def _load_state(self, default):
+        try:
+            with open(self._get_abs_path()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return default
+
+    def _save_state(self, state):
+        atomic_write(self._get_abs_path(), json.dumps(state))
+
+
+class ArticleUrlAllocator(JSONState):
+
+    """
+    Allocate unique rel_path of outputs directory to article, conflicts are
+    resolved by suffixes like '-2', '-3'. Allocations are persisted in the
+    state directory of theme simple, so that an article keeps its url.
+    """
+
+    STATE_REL_PATH = 'article_urls'
+
+    def __init__(self):
+        # input rel_path -> (preferred rel_path, allocated rel_path).
+        self._allocations = {}
+        # allocated rel_path -> input rel_path.
+        self._owners = {}
+
+    def _set_allocations(self, allocations):
+        self._allocations = allocations
+        self._owners = {
+            allocated: input_path
+            for input_path, (_, allocated) in allocations.items()
+        }
+
+    def load(self):
+        self._set_allocations(self._load_state({}))
+        return self
+
+    def save(self):
+        self._save_state(self._allocations)
+
+    def retain(self, input_paths):
+        # release urls of removed articles.
+        self._set_allocations({
+            input_path: self._allocations[input_path]
+            for input_path in input_paths
+            if input_path in self._allocations
+        })
+
+    def allocate(self, input_path, preferred):
+        allocation = self._allocations.get(input_path, None)
+        if allocation and allocation[0] == preferred:
+            return allocation[1]
+        elif allocation:
+            # preferred rel_path changed, release the old one.
+            del self._owners[allocation[1]]
+
+        head, ext = os.path.splitext(preferred)
+        allocated = preferred
+        suffix = 1
+        while allocated in self._owners:
+            suffix += 1
+            allocated = '{}-{}{}'.format(head, suffix, ext)
+
+        self._allocations[input_path] = (preferred, allocated)
+        self._owners[allocated] = input_path
+        return allocated
+
+
+class SearchDocIdAllocator(JSONState):
+
+    """
+    Allocate ids of documents of the search index to articles. Allocations are
+    persisted in the state directory of theme simple, so that an article keeps
+    its id, and shards of the index are not changed by adding or removing
+    other articles. Ids of removed articles are reused.
+    """
+
+    STATE_REL_PATH = 'search_doc_ids'
+
+    def __init__(self):
+        # input rel_path -> id.
+        self._ids = {}
+        self._used = set()
+
+    def _set_ids(self, ids):
+        self._ids = ids
+        self._used = set(ids.values())
+
+    def load(self):
+        self._set_ids(self._load_state({}))
+        return self
+
+    def save(self):
+        self._save_state(self._ids)
+
+    def retain(self, input_paths):
+        # release ids of removed articles.
+        self._set_ids({
+            input_path: self._ids[input_path]
+            for input_path in input_paths
+            if input_path in self._ids
+        })
+
+    def allocate(self, input_path):
+        doc_id = self._ids.get(input_path, None)
+        if doc_id is not None:
+            return doc_id
+
+        doc_id = 0
+        while doc_id in self._used:
+            doc_id += 1
+        self._ids[input_path] = doc_id
+        self._used.add(doc_id)
+        return doc_id
 
 
 class ArticlePageToFileMapping:
@@ -44,11 +646,22 @@ class ArticlePageToFileMapping:
     @classmethod
     def set_mapping(cls, article_page, article_file):
         cls._page_to_file_mapping[article_page] = article_file
+        ArticleIndex.clear()
 
     @classmethod
     def get_mapping(cls, article_page):
         return cls._page_to_file_mapping[article_page]
 
+    @classmethod
+    def remove_mapping(cls, article_page):
+        cls._page_to_file_mapping.pop(article_page, None)
+        ArticleIndex.clear()
+
+    @classmethod
+    def clear(cls):
+        cls._page_to_file_mapping.clear()
+        ArticleIndex.clear()
+
 
 def _get_env():
     template_path = os.path.join(
@@ -56,7 +669,15 @@ def _get_env():
         'templates',
     )
     loader = FileSystemLoader(template_path)
-    env = Environment(loader=loader)
+    # compiled templates are cached in the state directory.
+    bytecode_cache_path = os.path.join(
+        PathResolver.theme_state('simple', ensure_exist=True),
+        'jinja_cache',
+    )
+    if not os.path.exists(bytecode_cache_path):
+        os.makedirs(bytecode_cache_path)
+    bytecode_cache = FileSystemBytecodeCache(bytecode_cache_path)
+    env = Environment(loader=loader, bytecode_cache=bytecode_cache)
     return env
 
 
@@ -65,62 +686,143 @@ template_env = _get_env()
 
 class PageForRender:
 
+    __slots__ = ('url', 'title', 'date', 'post_time', 'input_rel_path')
+
     def __init__(self, article_page):
         self.url = article_page.url
 
         article_file = ArticlePageToFileMapping.get_mapping(article_page)
         self.title = article_file.meta_data['title']
-        self.post_time = article_file.meta_data['date'].strftime('%Y-%m-%d')
+        self.date = article_file.meta_data['date']
+        # same as strftime('%Y-%m-%d').
+        self.post_time = self.date.date().isoformat()
         self.input_rel_path = article_file.rel_path
 
 
-class XMLOperation:
+class ArticleIndex:
+
+    """
+    Articles sorted by date, built once and shared by generators of time line
+    and archive, and the sitemap. It is dropped whenever the mapping from
+    pages to files changes.
+    """
+
+    _pages = None
+    _post_times = None
+
+    @classmethod
+    def clear(cls):
+        cls._pages = None
+        cls._post_times = None
+
+    @classmethod
+    def _get_pages(cls, article_pages):
+        if cls._pages is None:
+            pages = [PageForRender(article_page)
+                     for article_page in article_pages]
+            # stable, articles of the same date keep their order.
+            pages.sort(key=attrgetter('date'))
+            cls._pages = pages
+        return cls._pages
+
+    @classmethod
+    def oldest_first(cls, article_pages):
+        return list(cls._get_pages(article_pages))
+
+    @classmethod
+    def newest_first(cls, article_pages):
+        # same as a stable sort in reverse order, articles of the same date
+        # keep their order.
+        pages = []
+        for _, group in groupby(reversed(cls._get_pages(article_pages)),
+                                key=attrgetter('date')):
+            pages.extend(reversed(list(group)))
+        return pages
+
+    @classmethod
+    def get_post_times(cls, article_pages):
+        # url -> post time.
+        if cls._post_times is None:
+            cls._post_times = {
+                page.url: page.post_time
+                for page in cls._get_pages(article_pages)
+            }
+        return cls._post_times
+
+
+class ArchiveOperation:
+
+    """
+    Ordering of the article tree, stored as versioned json in the state
+    directory of theme simple. archive_xml of earlier versions would be
+    migrated.
+    """
+
+    VERSION = 1
 
-    ROOT = 'root'
-    TOPIC = 'topic'
-    PAGE = 'page'
+    TOPICS = 'topics'
+    PAGES = 'pages'
 
+    STATE_REL_PATH = 'archive.json'
     XML_REL_PATH = 'archive_xml'
+    XML_PAGE = 'page'
 
-    def _get_xml_abs_path(self):
-        xml_path = os.path.join(
+    def _get_abs_path(self, rel_path):
+        return os.path.join(
             PathResolver.theme_state('simple', ensure_exist=True),
-            self.XML_REL_PATH,
+            rel_path,
         )
-        return xml_path
 
-    def construct_xml_tree(self, xml_parent, article_parent):
+    def construct_state_tree(self, article_parent):
         if None in article_parent:
             # leaf
-            for item in article_parent[None]:
-                page = ET.SubElement(xml_parent, self.PAGE)
-                page.attrib['title'] = item['title']
-                page.attrib['path'] = item['path']
-                page.attrib['url'] = item['url']
+            return {self.PAGES: article_parent[None]}
         else:
             # recursive build
+            topics = []
             for topic_name, sub_article_parent in article_parent.items():
-                topic = ET.SubElement(xml_parent, self.TOPIC)
-                topic.attrib['name'] = topic_name
-                self.construct_xml_tree(topic, sub_article_parent)
+                topic = {'name': topic_name}
+                topic.update(self.construct_state_tree(sub_article_parent))
+                topics.append(topic)
+            return {self.TOPICS: topics}
 
-    def load_xml(self):
-        xml_path = self._get_xml_abs_path()
+    def _iter_paths(self, state_parent):
+        for page in state_parent.get(self.PAGES, []):
+            yield page['path']
+        for topic in state_parent.get(self.TOPICS, []):
+            yield from self._iter_paths(topic)
+
+    def _load_xml_paths(self):
+        xml_path = self._get_abs_path(self.XML_REL_PATH)
+        try:
+            old_xml = ET.parse(xml_path).getroot()
+        except (OSError, ET.ParseError):
+            return []
+        return [node.attrib['path'] for node in old_xml.iter(self.XML_PAGE)]
+
+    def load_ordered_paths(self):
+        state_path = self._get_abs_path(self.STATE_REL_PATH)
+        if not os.path.exists(state_path):
+            return self._load_xml_paths()
         try:
-            with open(xml_path) as f:
-                archive_xml_str = f.read()
-            old_xml = ET.fromstring(archive_xml_str)
-        except:
-            old_xml = ET.Element(self.ROOT)
-        return old_xml
-
-    def generate_xml(self, article_tree):
-        xml_path = self._get_xml_abs_path()
-        new_xml = ET.Element(self.ROOT)
-        self.construct_xml_tree(new_xml, article_tree)
-
-        raw_xml = ET.tostring(new_xml, encoding='UTF-8')
-        reparse = minidom.parseString(raw_xml)
-        xml_str = reparse.toprettyxml(' ' * 4, os.linesep, 'UTF-8')
-        with open(xml_path, 'wb') as f:
-            f.write(xml_str)
+            with open(state_path, encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return []
+        if state.get('version', None) != self.VERSION:
+            return []
+        return list(self._iter_paths(state))
+
+    def save(self, article_tree):
+        state = {'version': self.VERSION}
+        state.update(self.construct_state_tree(article_tree))
+        state_str = json.dumps(state, indent=1, ensure_ascii=False)
+        atomic_write(
+            self._get_abs_path(self.STATE_REL_PATH),
+            state_str.encode('utf-8'),
+        )
+
+        # archive_xml has been migrated.
+        xml_path = self._get_abs_path(self.XML_REL_PATH)
+        if os.path.exists(xml_path):
+            os.remove(xml_path)
@@ -0,0 +1,363 @@
+"""
+Usage:
+    geekcms watch [--interval=<seconds>]
+
+Options:
+    --interval=<seconds>  Seconds between two scans of files. [default: 0.2]
+
+"""
+
+import os
+import time
+import traceback
+from collections import OrderedDict
+
+from jinja2 import meta
+
+from geekcms.protocol import BaseExtendedProcedure, PluginRegister
+from geekcms.loadup import PluginProcedure
+from geekcms.utils import PathResolver
+
+from .assets import (ArticleFile, AboutFile, IndexFile,
+                     StaticFileOfInputs, StaticFileOfThemeSimple,
+                     Page, ArticlePage, AboutPage, IndexPage,
+                     TimeLinePage, ArchivePage, SearchIndexPage)
+from .process import _TemplateRender
+from .write import PageWriter
+from .utils import (template_env, share_flag, AVALIABLE_MD_EXTENSIONS,
+                    ArticlePageToFileMapping, ArticleUrlAllocator,
+                    LoadManifest, AssetManifest)
+
+
+def _in_dir(path, dir_path):
+    return path.startswith(os.path.join(dir_path, ''))
+
+
+def _take_snapshot(dir_paths):
+    snapshot = {}
+    stack = list(dir_paths)
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+
+def _diff_snapshots(old_snapshot, new_snapshot):
+    changed_paths = set()
+    for path, signature in new_snapshot.items():
+        if old_snapshot.get(path, None) != signature:
+            changed_paths.add(path)
+    for path in old_snapshot:
+        if path not in new_snapshot:
+            changed_paths.add(path)
+    return changed_paths
+
+
+class TemplateDependency:
+
+    """
+    Reversed references(extends, include and import) between templates.
+    """
+
+    def __init__(self, env):
+        self._referrers = {}
+        for name in env.list_templates():
+            source, _, _ = env.loader.get_source(env, name)
+            for ref in meta.find_referenced_templates(env.parse(source)):
+                # None means the reference could not be resolved statically.
+                if ref is not None:
+                    self._referrers.setdefault(ref, set()).add(name)
+
+    def get_dependents(self, template_name):
+        # template_name itself, and templates referencing it.
+        dependents = set()
+        names = [template_name]
+        while names:
+            name = names.pop()
+            if name in dependents:
+                continue
+            dependents.add(name)
+            names.extend(self._referrers.get(name, ()))
+        return dependents
+
+
+class WarmBuild:
+
+    """
+    Keep plugins and assets of a build in memory, in order to re-run only the
+    stages affected by changed files:
+
+    1. article --> article page, time line page, archive page.
+    2. about/index --> about/index page.
+    3. static file --> static files of outputs.
+    4. template --> pages rendered by the template, or templates referencing
+    it.
+    5. any change --> pages and stages of writing.
+
+    Stages of writing are skipped if publish is false, leaving pages in
+    memory.
+    """
+
+    WRITE_COMPONENTS = ['pre_write', 'in_write', 'post_write']
+
+    # loader, resource, generator.
+    SINGLE_PAGE_DIRS = [
+        ('about', 'load_about', AboutFile, 'gen_about_page'),
+        ('index', 'load_index', IndexFile, 'gen_index_page'),
+    ]
+
+    # generator and class of its pages.
+    GENERATED_PAGES = {
+        'gen_article_page': ArticlePage,
+        'gen_about_page': AboutPage,
+        'gen_index_page': IndexPage,
+        'gen_time_line_page': TimeLinePage,
+        'gen_archive_page': ArchivePage,
+        'gen_search_index': SearchIndexPage,
+    }
+
+    def __init__(self, publish=True):
+        self.publish = publish
+        error_happend, exec_orders = PluginProcedure._get_execution_orders()
+        if error_happend:
+            raise SyntaxError('Error happended, suspend program.')
+
+        self._components = OrderedDict()
+        self._plugins = {}
+        for component in PluginProcedure.runtime_components:
+            plugins = []
+            for plugin_index in exec_orders[component]:
+                plugin = PluginRegister.get_plugin(plugin_index)()
+                plugins.append(plugin)
+                self._plugins[plugin_index.unique_key] = plugin
+            self._components[component] = plugins
+
+        theme_dir = PathResolver.theme_dir('simple')
+        self.template_dir = os.path.join(theme_dir, 'templates')
+        self.theme_static_dir = os.path.join(theme_dir, 'static')
+
+    def get_watched_dirs(self):
+        return [
+            PathResolver.inputs(),
+            self.template_dir,
+            self.theme_static_dir,
+        ]
+
+    def _get_plugin(self, plugin_name):
+        return self._plugins['simple.{}'.format(plugin_name)]
+
+    def run_all(self):
+        for component, plugins in self._components.items():
+            if not self.publish and component in self.WRITE_COMPONENTS:
+                continue
+            for plugin in plugins:
+                plugin.run()
+
+    def _render(self, md_files):
+        # render without md_cache, failed files would be removed.
+        processor = self._get_plugin('md_to_html')
+        rendered_files = []
+        for md_file in md_files:
+            try:
+                md_file.meta_data, md_file.html =\
+                    processor._render_with_path(md_file, processor._render,
+                                                md_file.text)
+            except Exception:
+                traceback.print_exc()
+                type(md_file).objects.remove(md_file)
+                continue
+            rendered_files.append(md_file)
+        return rendered_files
+
+    def _remove_articles(self, paths):
+        article_files = {}
+        for article_file in ArticleFile.objects.values():
+            article_files[article_file.abs_path] = article_file
+        article_pages = {}
+        for article_page in ArticlePage.objects.values():
+            article_file = ArticlePageToFileMapping.get_mapping(article_page)
+            article_pages[article_file] = article_page
+
+        for path in paths:
+            article_file = article_files.pop(path, None)
+            if article_file is None:
+                continue
+            ArticleFile.objects.remove(article_file)
+            article_page = article_pages.get(article_file, None)
+            if article_page is not None:
+                ArticlePage.objects.remove(article_page)
+                ArticlePageToFileMapping.remove_mapping(article_page)
+        return list(article_files.values())
+
+    def _rebuild_articles(self, paths):
+        loader = self._get_plugin('load_article')
+        generator = self._get_plugin('gen_article_page')
+        remaining_files = self._remove_articles(paths)
+
+        # load and render files still existing.
+        manager = loader.get_manager_bind_with_plugin(ArticleFile)
+        new_files = []
+        for path in sorted(paths):
+            name = os.path.basename(path)
+            if not os.path.isfile(path) or\
+                    not loader._is_avaliable_file(name,
+                                                  AVALIABLE_MD_EXTENSIONS):
+                continue
+            new_files.append(loader._load_file(manager, path, os.stat(path)))
+        new_files = self._render(new_files)
+
+        url_allocator = ArticleUrlAllocator().load()
+        url_allocator.retain(
+            article_file.rel_path
+            for article_file in remaining_files + new_files
+        )
+        for article_file in new_files:
+            rel_path = generator._generate_article_rel_path(
+                url_allocator,
+                article_file.rel_path,
+            )
+            generator._generate_article_page(article_file, rel_path)
+        url_allocator.save()
+
+    def _reload(self, loader_name, resource_cls):
+        resource_cls.objects.clear()
+        self._get_plugin(loader_name).run()
+        return resource_cls.objects.values()
+
+    def _get_generators_of_templates(self, template_names):
+        dependency = TemplateDependency(template_env)
+        dependents = set()
+        for template_name in template_names:
+            dependents.update(dependency.get_dependents(template_name))
+
+        generators = set()
+        for plugin in self._plugins.values():
+            templates = getattr(plugin, 'TEMPLATES', ())
+            if plugin.theme == 'simple' and dependents.intersection(templates):
+                generators.add(plugin.plugin)
+        return generators
+
+    def _regenerate(self, generators):
+        for component in ['in_process', 'post_process']:
+            for plugin in self._components[component]:
+                if plugin.plugin not in generators or plugin.theme != 'simple':
+                    continue
+                self.GENERATED_PAGES[plugin.plugin].objects.clear()
+                if plugin.plugin == 'gen_article_page':
+                    ArticlePageToFileMapping.clear()
+                plugin.run()
+
+    def _publish(self, new_pages):
+        incremental = share_flag('simple.incremental_write', True)
+        for component in self.WRITE_COMPONENTS:
+            for plugin in self._components[component]:
+                if incremental and isinstance(plugin, PageWriter):
+                    # other pages have been written.
+                    plugin.write_pages(new_pages)
+                else:
+                    plugin.run()
+
+    def rebuild(self, changed_paths):
+        LoadManifest.reset()
+        pages_before = set(Page.objects.values())
+        generators = set()
+
+        article_dir = os.path.join(PathResolver.inputs(), 'article')
+        article_paths = [path for path in changed_paths
+                         if _in_dir(path, article_dir)]
+        if article_paths:
+            self._rebuild_articles(article_paths)
+            generators.update(['gen_time_line_page', 'gen_archive_page',
+                               'gen_search_index'])
+
+        for dirname, loader_name, resource_cls, generator_name in\
+                self.SINGLE_PAGE_DIRS:
+            dir_path = os.path.join(PathResolver.inputs(), dirname)
+            if any(_in_dir(path, dir_path) for path in changed_paths):
+                self._render(self._reload(loader_name, resource_cls))
+                generators.add(generator_name)
+
+        static_dirs = [
+            (os.path.join(PathResolver.inputs(), 'static'),
+             'load_inputs_static', StaticFileOfInputs),
+            (self.theme_static_dir,
+             'load_theme_static', StaticFileOfThemeSimple),
+        ]
+        for dir_path, loader_name, resource_cls in static_dirs:
+            if any(_in_dir(path, dir_path) for path in changed_paths):
+                self._reload(loader_name, resource_cls)
+        if any(_in_dir(path, self.theme_static_dir) for path in changed_paths):
+            asset_digest = AssetManifest.digest()
+            self._get_plugin('minify_static').run()
+            self._get_plugin('fingerprint').run()
+            if AssetManifest.digest() != asset_digest:
+                # urls of assets in every page are changed.
+                _TemplateRender.clear_template_renders()
+                generators.update(self.GENERATED_PAGES)
+
+        template_names = [os.path.relpath(path, self.template_dir)
+                          for path in changed_paths
+                          if _in_dir(path, self.template_dir)]
+        if template_names:
+            _TemplateRender.clear_template_renders()
+            generators.update(
+                self._get_generators_of_templates(template_names),
+            )
+
+        self._regenerate(generators)
+        if self.publish:
+            self._publish(set(Page.objects.values()) - pages_before)
+
+
+class Watcher(BaseExtendedProcedure):
+
+    def get_command_and_explanation(self):
+        return ('watch',
+                'Rebuild affected pages whenever inputs or templates change.')
+
+    def get_doc(self):
+        return __doc__
+
+    def run(self, args):
+        interval = float(args['--interval'])
+
+        warm_build = WarmBuild()
+        warm_build.run_all()
+        watched_dirs = warm_build.get_watched_dirs()
+        snapshot = _take_snapshot(watched_dirs)
+        print('Watching {}'.format(', '.join(watched_dirs)))
+
+        try:
+            while True:
+                time.sleep(interval)
+                new_snapshot = _take_snapshot(watched_dirs)
+                changed_paths = _diff_snapshots(snapshot, new_snapshot)
+                if not changed_paths:
+                    continue
+                snapshot = new_snapshot
+
+                start = time.perf_counter()
+                try:
+                    warm_build.rebuild(changed_paths)
+                except Exception:
+                    # keep watching, the next change would trigger another
+                    # rebuild.
+                    traceback.print_exc()
+                    continue
+                print('Rebuilt {} changed file(s) in {:.3f}s.'.format(
+                    len(changed_paths),
+                    time.perf_counter() - start,
+                ))
+        except KeyboardInterrupt:
+            pass
@@ -1,7 +1,17 @@
 
+import io
 import os
+import re
+import gzip
 import shutil
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 from geekcms.protocol import BasePlugin
 from geekcms.protocol import PluginController as pcl
@@ -10,26 +20,61 @@ from geekcms.utils import PathResolver, ShareData
 from .assets import (Page, ArticlePage, TimeLinePage,
                      ArchivePage, AboutPage, IndexPage,
                      StaticFile)
-from .utils import template_env
+from .instrument import instrument
+from .minify import VERSION as MINIFY_VERSION, minify_all, MinifiedSizes
+from .utils import (share_flag, share_int, content_hash, file_hash,
+                    atomic_write, OutputManifest, OutputChanges,
+                    ArticleIndex, StateCache, JSONState)
 
 
-class OutputCleaner(BasePlugin):
+class OutputMinifier(BasePlugin):
 
-    plugin = 'clean'
+    """
+    Minify html pages if minify is true. Minified pages are cached by content
+    hash in states/simple/minify_cache, cache misses could be minified by
+    minify_workers processes. css/js files of theme are minified by
+    minify_static before being fingerprinted.
+    """
 
-    def run(self, resources):
-        for name in os.listdir(PathResolver.outputs()):
-            if name.startswith('.'):
+    plugin = 'minify'
+
+    CACHE_REL_PATH = 'minify_cache'
+
+    @instrument
+    @pcl.accept_parameters(
+        (pcl.PRODUCTS, Page),
+    )
+    def run(self, pages):
+        if not share_flag('simple.minify', False):
+            return
+
+        cache = StateCache(self.CACHE_REL_PATH, 2 * len(pages) + 64).load()
+        sizes = MinifiedSizes()
+        missed = []
+        for page in pages:
+            if page.minified or not page.rel_path.endswith('.html'):
                 continue
+            key = content_hash(str(MINIFY_VERSION), '.html', page.text)
+            minified = cache.get(key)
+            if minified is None:
+                missed.append((page, key))
+                continue
+            sizes.count('.html', page.text, minified)
+            page.text = minified
+            page.minified = True
 
-            path = os.path.join(
-                PathResolver.outputs(),
-                name,
-            )
-            if os.path.isfile(path):
-                os.remove(path)
-            elif os.path.isdir(path):
-                shutil.rmtree(path)
+        results = minify_all(
+            [('.html', page.text) for page, _ in missed],
+            share_int('simple.minify_workers', 1),
+        )
+        for (page, key), minified in zip(missed, results):
+            cache.set(key, minified)
+            sizes.count('.html', page.text, minified)
+            page.text = minified
+            page.minified = True
+
+        cache.save()
+        sizes.report(self.plugin)
 
 
 class _TargetAbsPath:
@@ -46,48 +91,276 @@ class _TargetAbsPath:
         if not os.path.exists(dir_path):
             os.makedirs(dir_path)
 
+    def _remove_empty_dirs(self, dir_path):
+        outputs = PathResolver.outputs()
+        while dir_path != outputs and not os.listdir(dir_path):
+            os.rmdir(dir_path)
+            dir_path, _ = os.path.split(dir_path)
+
+    def _report(self, written, skipped):
+        print('{}: {} written, {} skipped.'.format(
+            self.plugin, written, skipped,
+        ))
+
+
+def _gzip_compress(data):
+    # mtime of gzip header is fixed, so identical pages produce identical
+    # files.
+    buf = io.BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class OutputCleaner(BasePlugin, _TargetAbsPath):
+
+    """
+    In incremental mode, only delete files written by previous builds which
+    are not going to be written again. Otherwise, delete everything.
+    """
+
+    plugin = 'clean'
+
+    def _clean_all(self):
+        for name in os.listdir(PathResolver.outputs()):
+            if name.startswith('.'):
+                continue
+
+            path = os.path.join(
+                PathResolver.outputs(),
+                name,
+            )
+            if os.path.isfile(path):
+                os.remove(path)
+            elif os.path.isdir(path):
+                shutil.rmtree(path)
+
+    def _clean_orphans(self, rel_paths):
+        deleted = 0
+        for rel_path in OutputManifest.paths():
+            if rel_path in rel_paths:
+                continue
+            OutputManifest.remove(rel_path)
+
+            path = os.path.join(
+                PathResolver.outputs(),
+                rel_path,
+            )
+            if os.path.isfile(path):
+                os.remove(path)
+                self._remove_empty_dirs(os.path.dirname(path))
+                deleted += 1
+        return deleted
+
+    @instrument
+    @pcl.accept_parameters(
+        (pcl.RESOURCES, StaticFile),
+        (pcl.PRODUCTS, Page),
+    )
+    def run(self, static_files, pages):
+        if not share_flag('simple.incremental_write', True):
+            self._clean_all()
+            OutputChanges.mark_full()
+            OutputChanges.save()
+            return
+
+        rel_paths = set(static_file.output_rel_path
+                        for static_file in static_files)
+        rel_paths.update(page.rel_path for page in pages)
+        deleted = self._clean_orphans(rel_paths)
+        OutputManifest.save()
+        print('{}: {} deleted.'.format(self.plugin, deleted))
+
 
 class StaticWriter(BasePlugin, _TargetAbsPath):
 
     """
     1. Write static files of inputs.
     2. Write static files of themes.
+
+    Files are published by hardlink (if static_publish is 'link') or copied
+    in kernel, with fallback to plain copy. Targets with the same size and
+    mtime as the source, or the same content hash as the last build, are
+    skipped. A hardlinked target edited along with its source is recorded as
+    changed, if its size or mtime differs from the last build.
     """
 
     plugin = 'write_static'
 
+    LINK = 'link'
+
+    def _is_up_to_date(self, src_stat, tgt_abs_path):
+        try:
+            tgt_stat = os.stat(tgt_abs_path)
+        except OSError:
+            return False
+        return (src_stat.st_size == tgt_stat.st_size and
+                src_stat.st_mtime_ns == tgt_stat.st_mtime_ns)
+
+    def _is_edited_in_place(self, rel_path, src_stat, tgt_abs_path):
+        # a hardlinked target changes along with its source, which is told by
+        # the size and mtime recorded by the last build.
+        if not os.path.samestat(src_stat, os.stat(tgt_abs_path)):
+            return False
+        return not OutputManifest.is_recorded(rel_path, src_stat.st_size,
+                                              src_stat.st_mtime_ns)
+
+    def _copy_in_kernel(self, src_fd, tgt_fd, size):
+        # copy_file_range could reflink, sendfile is the fallback of it.
+        copy_file_range = getattr(os, 'copy_file_range', None)
+        offset = 0
+        while offset < size:
+            if copy_file_range:
+                sent = copy_file_range(src_fd, tgt_fd, size - offset)
+            else:
+                sent = os.sendfile(tgt_fd, src_fd, offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+
+    def _copy(self, src_abs_path, tgt_abs_path, src_stat):
+        with open(src_abs_path, 'rb') as src, open(tgt_abs_path, 'wb') as tgt:
+            try:
+                self._copy_in_kernel(src.fileno(), tgt.fileno(),
+                                     src_stat.st_size)
+            except OSError:
+                # not supported by the file system.
+                src.seek(0)
+                tgt.seek(0)
+                tgt.truncate()
+                shutil.copyfileobj(src, tgt)
+        # let the target have the same mtime as the source.
+        os.utime(tgt_abs_path,
+                 ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+
+    def _publish(self, src_abs_path, tgt_abs_path, src_stat):
+        # never write through an existing target, which might be a hardlink
+        # of the source.
+        if os.path.lexists(tgt_abs_path):
+            os.remove(tgt_abs_path)
+        if ShareData.get('simple.static_publish') == self.LINK:
+            try:
+                os.link(src_abs_path, tgt_abs_path)
+                return
+            except OSError:
+                # cross devices or not supported, fall back to copy.
+                pass
+        self._copy(src_abs_path, tgt_abs_path, src_stat)
+
+    @instrument
     @pcl.accept_parameters(
         (pcl.RESOURCES, StaticFile),
     )
     def run(self, static_files):
+        written = skipped = 0
         for static_file in static_files:
-            tgt_abs_path = self._get_tgt_abs_path(static_file.rel_path)
+            src_abs_path = static_file.publish_abs_path
+            tgt_abs_path = self._get_tgt_abs_path(static_file.output_rel_path)
+            src_stat = os.stat(src_abs_path)
+            if self._is_up_to_date(src_stat, tgt_abs_path):
+                if not self._is_edited_in_place(static_file.output_rel_path,
+                                                src_stat, tgt_abs_path):
+                    skipped += 1
+                    continue
+                # already published through the link, only record it.
+                OutputManifest.record(
+                    static_file.output_rel_path,
+                    file_hash(src_abs_path),
+                    src_stat.st_size,
+                    src_stat.st_mtime_ns,
+                )
+                written += 1
+                continue
+
+            digest = file_hash(src_abs_path)
+            if OutputManifest.is_unchanged(static_file.output_rel_path,
+                                           digest):
+                # same content, only sync mtime for the next build.
+                os.utime(tgt_abs_path,
+                         ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+                skipped += 1
+                continue
+
             self._make_sure_dir_exist(tgt_abs_path)
-            shutil.copyfile(
-                static_file.abs_path,
-                tgt_abs_path,
+            self._publish(src_abs_path, tgt_abs_path, src_stat)
+            OutputManifest.record(
+                static_file.output_rel_path,
+                digest,
+                src_stat.st_size,
+                src_stat.st_mtime_ns,
             )
+            written += 1
+        OutputManifest.save()
+        self._report(written, skipped)
 
 
 class PageWriter(BasePlugin, _TargetAbsPath):
 
+    """
+    Pages with the same content hash as the last build are skipped. Others
+    are written atomically by a pool of write_workers threads, after all
+    directories needed have been created.
+    """
+
     plugin = 'write_page'
 
+    def _make_sure_dirs_exist(self, tgt_abs_paths):
+        created_dirs = set()
+        for tgt_abs_path in tgt_abs_paths:
+            dir_path = os.path.dirname(tgt_abs_path)
+            if dir_path not in created_dirs:
+                os.makedirs(dir_path, exist_ok=True)
+                created_dirs.add(dir_path)
+
+    def _write_files(self, files):
+        # number of writing threads, 1 means writing in current thread.
+        workers = share_int('simple.write_workers', 4)
+        if workers <= 1 or len(files) <= 1:
+            for tgt_abs_path, data in files:
+                atomic_write(tgt_abs_path, data)
+            return
+
+        with ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(atomic_write, tgt_abs_path, data)
+                       for tgt_abs_path, data in files]
+            for future in futures:
+                # raise the first error of writing.
+                future.result()
+
+    def write_pages(self, pages):
+        changed = []
+        skipped = 0
+        for page in pages:
+            data = page.text.encode('utf-8')
+            digest = content_hash(data)
+            if OutputManifest.is_unchanged(page.rel_path, digest):
+                skipped += 1
+                continue
+            changed.append((page.rel_path, data, digest))
+
+        files = [(self._get_tgt_abs_path(rel_path), data)
+                 for rel_path, data, _ in changed]
+        self._make_sure_dirs_exist(tgt_abs_path for tgt_abs_path, _ in files)
+        self._write_files(files)
+
+        for rel_path, data, digest in changed:
+            OutputManifest.record(rel_path, digest, len(data))
+        OutputManifest.save()
+        self._report(len(changed), skipped)
+
+    @instrument
     @pcl.accept_parameters(
         (pcl.PRODUCTS, Page),
     )
     def run(self, pages):
-        for page in pages:
-            tgt_abs_path = self._get_tgt_abs_path(page.rel_path)
-            self._make_sure_dir_exist(tgt_abs_path)
-            with open(tgt_abs_path, 'w') as f:
-                f.write(page.text)
+        self.write_pages(pages)
 
 
 class CNAMEWriter(BasePlugin):
 
     plugin = 'cname'
 
+    @instrument
     def run(self):
         domain = ShareData.get('global.domain')
         tgt_abs_path = os.path.join(
@@ -96,12 +369,135 @@ class CNAMEWriter(BasePlugin):
         )
         with open(tgt_abs_path, 'w') as f:
             f.write(domain)
+        OutputChanges.add('CNAME')
+        OutputChanges.save()
+
+
+class _SitemapStream:
+
+    """
+    Write <url> entries one by one, switch to a new file before the limits of
+    sitemap protocol are exceeded.
+    """
+
+    MAX_URLS = 50000
+    MAX_BYTES = 50 * 1024 * 1024
+
+    HEAD = (b'<?xml version="1.0" encoding="UTF-8"?>\n'
+            b'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+    TAIL = b'</urlset>\n'
+
+    def __init__(self, path_of_index):
+        self._path_of_index = path_of_index
+        self._file = None
+        # (path, lastmod) of closed files.
+        self.files = []
+
+    def _open(self):
+        self._file = open(self._path_of_index(len(self.files) + 1), 'wb')
+        self._file.write(self.HEAD)
+        self._urls = 0
+        self._bytes = len(self.HEAD)
+        self._lastmod = None
+
+    def _close(self):
+        self._file.write(self.TAIL)
+        self._file.close()
+        self.files.append((self._file.name, self._lastmod))
+        self._file = None
+
+    def write(self, loc, lastmod=None):
+        entry = '\t<url>\n\t\t<loc>{}</loc>\n'.format(escape(loc))
+        if lastmod:
+            entry += '\t\t<lastmod>{}</lastmod>\n'.format(lastmod)
+        entry = (entry + '\t</url>\n').encode('utf-8')
+
+        if self._file and (
+                self._urls == self.MAX_URLS or
+                self._bytes + len(entry) + len(self.TAIL) > self.MAX_BYTES):
+            self._close()
+        if self._file is None:
+            self._open()
+        self._file.write(entry)
+        self._urls += 1
+        self._bytes += len(entry)
+        if lastmod and (self._lastmod is None or lastmod > self._lastmod):
+            self._lastmod = lastmod
+
+    def close(self):
+        # always produce at least one file.
+        if self._file is None and not self.files:
+            self._open()
+        if self._file:
+            self._close()
+        return self.files
 
 
 class SitemapGenerator(BasePlugin):
 
+    """
+    Sitemap is streamed to outputs. If all urls fit in a single file, it is
+    written to sitemap.xml, otherwise to sitemap-<n>.xml with sitemap.xml as
+    the sitemap index.
+    """
+
     plugin = 'sitemap'
 
+    SITEMAP = 'sitemap.xml'
+    SITEMAP_PART_RE = re.compile(r'^sitemap-(\d+)\.xml$')
+
+    def _get_part_abs_path(self, index):
+        return os.path.join(
+            PathResolver.outputs(),
+            'sitemap-{}.xml'.format(index),
+        )
+
+    def _write_index(self, http_domain, files):
+        sitemap_abs_path = os.path.join(PathResolver.outputs(), self.SITEMAP)
+        with open(sitemap_abs_path, 'wb') as f:
+            f.write(
+                b'<?xml version="1.0" encoding="UTF-8"?>\n'
+                b'<sitemapindex '
+                b'xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+            )
+            for path, lastmod in files:
+                entry = '\t<sitemap>\n\t\t<loc>{}</loc>\n'.format(
+                    escape(urllib.parse.urljoin(http_domain,
+                                                os.path.basename(path))),
+                )
+                if lastmod:
+                    entry += '\t\t<lastmod>{}</lastmod>\n'.format(lastmod)
+                f.write((entry + '\t</sitemap>\n').encode('utf-8'))
+            f.write(b'</sitemapindex>\n')
+
+    def _remove_stale_parts(self, count):
+        # parts left by previous builds with more urls.
+        for name in os.listdir(PathResolver.outputs()):
+            match = self.SITEMAP_PART_RE.match(name)
+            if match and int(match.group(1)) > count:
+                os.remove(os.path.join(PathResolver.outputs(), name))
+                OutputChanges.add(name)
+
+    def _write_robots(self, sitemap_url):
+        robots_abs_path = os.path.join(
+            PathResolver.outputs(),
+            'robots.txt',
+        )
+        old_text = None
+        lines = []
+        if os.path.exists(robots_abs_path):
+            with open(robots_abs_path) as f:
+                old_text = f.read()
+            # keep lines other than the sitemap.
+            lines = [line for line in old_text.splitlines()
+                     if not line.lower().startswith('sitemap:')]
+        lines.append('Sitemap: {}'.format(sitemap_url))
+        text = '\n'.join(lines) + '\n'
+        if text != old_text:
+            atomic_write(robots_abs_path, text)
+            OutputChanges.add('robots.txt')
+
+    @instrument
     @pcl.accept_parameters(
         (pcl.PRODUCTS, Page),
     )
@@ -109,34 +505,185 @@ class SitemapGenerator(BasePlugin):
         # domain would not be escaped.
         http_domain = 'http://{}'.format(ShareData.get('global.domain'))
 
-        # generate sitemap.
-        urls = []
-        for page in pages:
+        # post times of articles as lastmod.
+        lastmods = ArticleIndex.get_post_times(
+            [page for page in pages if isinstance(page, ArticlePage)],
+        )
+        stream = _SitemapStream(self._get_part_abs_path)
+        pages = [page for page in pages if page.IN_SITEMAP]
+        for page in sorted(pages, key=lambda page: page.url):
             url = urllib.parse.urljoin(
                 http_domain,
                 # escape page url.
                 urllib.parse.quote(page.url),
             )
-            urls.append(url)
+            stream.write(url, lastmods.get(page.url, None))
+        files = stream.close()
+
+        if len(files) == 1:
+            path, _ = files[0]
+            os.replace(
+                path,
+                os.path.join(PathResolver.outputs(), self.SITEMAP),
+            )
+            self._remove_stale_parts(0)
+        else:
+            self._write_index(http_domain, files)
+            self._remove_stale_parts(len(files))
+            for path, _ in files:
+                OutputChanges.add(os.path.basename(path))
+        OutputChanges.add(self.SITEMAP)
 
-        xml_template = template_env.get_template('simple_xml.xml')
         # url of sitemap would not be escaped.
-        sitemap_abs_path = os.path.join(
-            PathResolver.outputs(),
-            'sitemap.xml',
-        )
-        with open(sitemap_abs_path, 'w') as f:
-            xml_text = xml_template.render(urls=urls)
-            f.write(xml_text)
+        self._write_robots(urllib.parse.urljoin(http_domain, self.SITEMAP))
+        OutputChanges.save()
 
-        # add sitemap to robots.txt.
-        robots_abs_path = os.path.join(
-            PathResolver.outputs(),
-            'robots.txt',
-        )
-        sitemap_url = urllib.parse.urljoin(
-            http_domain,
-            'sitemap.xml',
+
+class OutputCompressor(BasePlugin, _TargetAbsPath, JSONState):
+
+    """
+    Write precompressed siblings(.gz, and .br if brotli is installed and
+    compress_brotli is true) of html, css, js, xml and json files of outputs,
+    for static servers serving them directly. A compressed file has the same
+    mtime as its source, and would not be compressed again until the source
+    changed.
+
+    Written files are listed in states/simple/compressed_outputs. Only listed
+    files are deleted, when their source is gone or their encoding is
+    disabled, all of them if compress is false. Static files of outputs are
+    never compressed or deleted.
+    """
+
+    plugin = 'compress'
+
+    STATE_REL_PATH = 'compressed_outputs'
+    COMPRESSIBLE_EXTENSIONS = ('.html', '.css', '.js', '.xml', '.json')
+
+    def _get_encodings(self):
+        # suffix and function compressing bytes.
+        encodings = [('.gz', _gzip_compress)]
+        if brotli is not None and share_flag('simple.compress_brotli', False):
+            encodings.append(('.br', brotli.compress))
+        return encodings
+
+    def _scan_outputs(self):
+        # yield (path, stat) of files, hidden directories(.git) are skipped.
+        dir_paths = [PathResolver.outputs()]
+        while dir_paths:
+            for entry in os.scandir(dir_paths.pop()):
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    dir_paths.append(entry.path)
+                elif entry.is_file():
+                    try:
+                        yield entry.path, entry.stat()
+                    except OSError:
+                        # removed while scanning.
+                        continue
+
+    def _is_up_to_date(self, src_stat, tgt_abs_path):
+        try:
+            tgt_stat = os.stat(tgt_abs_path)
+        except OSError:
+            return False
+        return src_stat.st_mtime_ns == tgt_stat.st_mtime_ns
+
+    def _compress(self, src_abs_path, src_stat, targets):
+        with open(src_abs_path, 'rb') as f:
+            data = f.read()
+        for tgt_abs_path, compress in targets:
+            atomic_write(tgt_abs_path, compress(data))
+            OutputChanges.add(
+                os.path.relpath(tgt_abs_path, PathResolver.outputs()),
+            )
+            os.utime(tgt_abs_path,
+                     ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+
+    def _is_orphan(self, path, sources, suffixes):
+        # path is a compressed file of outputs.
+        src_abs_path, suffix = os.path.splitext(path)
+        return src_abs_path not in sources or suffix not in suffixes
+
+    def _remove(self, rel_paths):
+        # return number of files deleted, which might have been cleaned up.
+        deleted = 0
+        for rel_path in rel_paths:
+            path = self._get_tgt_abs_path(rel_path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            OutputChanges.add(rel_path)
+            self._remove_empty_dirs(os.path.dirname(path))
+            deleted += 1
+        return deleted
+
+    def _report(self, written, skipped, deleted):
+        print('{}: {} written, {} skipped, {} deleted.'.format(
+            self.plugin, written, skipped, deleted,
+        ))
+
+    @instrument
+    @pcl.accept_parameters(
+        (pcl.RESOURCES, StaticFile),
+    )
+    def run(self, static_files):
+        static_rel_paths = set(static_file.output_rel_path
+                               for static_file in static_files)
+        # files replaced by static files are no longer owned.
+        compressed = set(self._load_state([])) - static_rel_paths
+        if not share_flag('simple.compress', False):
+            if not compressed:
+                return
+            # compressed files of earlier builds would go stale.
+            deleted = self._remove(compressed)
+            self._save_state([])
+            OutputChanges.save()
+            self._report(0, 0, deleted)
+            return
+
+        encodings = self._get_encodings()
+        suffixes = tuple(suffix for suffix, _ in encodings)
+
+        sources = {}
+        for path, stat in self._scan_outputs():
+            if path.endswith(self.COMPRESSIBLE_EXTENSIONS):
+                sources[path] = stat
+
+        jobs = []
+        skipped = 0
+        for src_abs_path, src_stat in sorted(sources.items()):
+            targets = []
+            for suffix, compress in encodings:
+                tgt_abs_path = src_abs_path + suffix
+                tgt_rel_path = os.path.relpath(tgt_abs_path,
+                                               PathResolver.outputs())
+                if tgt_rel_path in static_rel_paths:
+                    continue
+                compressed.add(tgt_rel_path)
+                if not self._is_up_to_date(src_stat, tgt_abs_path):
+                    targets.append((tgt_abs_path, compress))
+            if targets:
+                jobs.append((src_abs_path, src_stat, targets))
+            else:
+                skipped += 1
+
+        # zlib and brotli release the GIL while compressing.
+        workers = share_int('simple.write_workers', 4)
+        with ThreadPoolExecutor(max(workers, 1)) as executor:
+            futures = [executor.submit(self._compress, *job) for job in jobs]
+            for future in futures:
+                future.result()
+
+        # remove compressed files whose source is gone, or whose encoding is
+        # disabled.
+        orphans = set(
+            rel_path for rel_path in compressed
+            if self._is_orphan(self._get_tgt_abs_path(rel_path),
+                               sources, suffixes)
         )
-        with open(robots_abs_path, 'a') as f:
-            f.write('Sitemap: {}'.format(sitemap_url))
+        deleted = self._remove(orphans)
+        self._save_state(sorted(compressed - orphans))
+        OutputChanges.save()
+        self._report(len(jobs), skipped, deleted)
@@ -0,0 +1,154 @@
+"""
+GitUploader against a local bare repository as remote.
+"""
+
+import os
+import json
+import subprocess
+
+import pytest
+
+from geekcms.utils import (PathResolver, ShareData, SettingsLoader,
+                           SysPathContextManager)
+
+
+THEMES_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'simple', 'themes',
+)
+
+with SysPathContextManager('git_upload', THEMES_DIR):
+    from git_upload.plugin import GitUploader
+
+
+def _git(*args):
+    return subprocess.check_output(['git'] + list(args)).decode('utf-8')
+
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+class _Project:
+
+    def __init__(self, root):
+        self.remote = str(root / 'remote.git')
+        self.path = str(root / 'project')
+        self.outputs = os.path.join(self.path, 'outputs')
+        os.makedirs(os.path.join(self.path, 'states'))
+        _git('init', '-q', '--bare', self.remote)
+        _git('clone', '-q', self.remote, self.outputs)
+
+    def write_output(self, rel_path, text):
+        _write(os.path.join(self.outputs, rel_path), text)
+
+    def remove_output(self, rel_path):
+        os.remove(os.path.join(self.outputs, rel_path))
+
+    def record_changes(self, paths):
+        _write(
+            os.path.join(self.path, 'states', 'simple', 'output_changes'),
+            json.dumps({'full': False, 'paths': paths}),
+        )
+
+    def upload(self):
+        GitUploader().run({'--full': False})
+
+    def remote_commits(self):
+        return _git('--git-dir', self.remote,
+                    'rev-list', 'HEAD').split()
+
+    def remote_files(self):
+        # rel_path -> content.
+        names = _git('--git-dir', self.remote,
+                     'ls-tree', '-r', '--name-only', 'HEAD').split('\n')
+        return {
+            name: _git('--git-dir', self.remote, 'show', 'HEAD:' + name)
+            for name in names if name
+        }
+
+    def last_commit_paths(self):
+        # paths changed by the last commit of remote.
+        return sorted(_git('--git-dir', self.remote, 'diff-tree', '-r',
+                           '--name-only', '--no-commit-id', 'HEAD')
+                      .split())
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    for name in ('AUTHOR', 'COMMITTER'):
+        monkeypatch.setenv('GIT_{}_NAME'.format(name), 'GeekCMS')
+        monkeypatch.setenv('GIT_{}_EMAIL'.format(name), 'geekcms@localhost')
+    monkeypatch.chdir(tmp_path)
+
+    project = _Project(tmp_path)
+    PathResolver.set_project_path(project.path)
+    ShareData.load_data(SettingsLoader(
+        os.path.join(THEMES_DIR, 'git_upload', 'settings'),
+        'git_upload',
+    ))
+    yield project
+    ShareData.clear()
+    PathResolver.set_project_path(None)
+
+
+def _upload_first(project):
+    project.write_output('index.html', 'index')
+    project.write_output('css/site.css', 'body {}')
+    project.upload()
+
+
+def test_first_upload(project, capsys):
+    _upload_first(project)
+
+    assert 'Staging all files.' in capsys.readouterr().out
+    assert len(project.remote_commits()) == 1
+    assert project.remote_files() == {
+        'index.html': 'index',
+        'css/site.css': 'body {}',
+    }
+
+
+def test_nothing_changed(project, capsys):
+    _upload_first(project)
+    project.record_changes(['index.html'])
+    project.upload()
+
+    assert 'Nothing changed, commit skipped.' in capsys.readouterr().out
+    assert len(project.remote_commits()) == 1
+
+
+def test_changed_files_staged(project, capsys):
+    _upload_first(project)
+    project.write_output('index.html', 'index, edited')
+    project.write_output('about/index.html', 'about')
+    # not recorded as changed, so not staged.
+    project.write_output('css/site.css', 'body {color: red}')
+    project.record_changes(['index.html', 'about/index.html'])
+    project.upload()
+
+    assert 'Staging 2 changed file(s).' in capsys.readouterr().out
+    assert len(project.remote_commits()) == 2
+    assert project.last_commit_paths() == ['about/index.html', 'index.html']
+    assert project.remote_files() == {
+        'index.html': 'index, edited',
+        'about/index.html': 'about',
+        'css/site.css': 'body {}',
+    }
+
+
+def test_deleted_file_removed(project):
+    _upload_first(project)
+    project.remove_output('css/site.css')
+    project.record_changes(['css/site.css'])
+    project.upload()
+
+    assert len(project.remote_commits()) == 2
+    assert project.last_commit_paths() == ['css/site.css']
+    assert project.remote_files() == {'index.html': 'index'}
+    # the change manifest is consumed by a successful upload.
+    assert not os.path.exists(
+        os.path.join(project.path, 'states', 'simple', 'output_changes'),
+    )